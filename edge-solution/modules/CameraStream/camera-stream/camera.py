@@ -1,36 +1,113 @@
 import cv2
-import os
 import logging
 import time
 import json
 import datetime
+import math
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from azure.storage.blob import BlobServiceClient
 import requests
 import threading
 from streamer.videostream import VideoStream
-import imutils
-import mmap
-
-from messaging.iotmessenger import IoTInferenceMessenger
+from streamer.process_stream import ProcessVideoStream
+from streamer.shared_memory import SharedMemoryManager
+from streamer.motion import MotionGate
+from tracking.tracker import ObjectTracker
+from tracking.zones import ZoneOccupancy
+from storage.blob_uploader import BlobUploader
+from inference.detector_client import DetectorClient, CircuitOpenError
+from inference.preprocess import FrameResizer
+from metrics import camera_metrics
+
+from messaging.iotmessenger import IoTInferenceMessenger, BatchingIoTMessenger
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
 
 camera_config = None
-received_twin_patch = False
-twin_patch = None
+# desired properties as of the last patch, patches only carry what changed
+twin_desired = dict()
+# patches received but not applied yet
+twin_patches = []
+twin_patches_lock = threading.Lock()
 shared_memory = None
 shared_memory_name='image'
 shared_memory_size = 50 * 1024 * 1024
+shared_memory_slots = 8
+# camera pipelines allowed to run at the same time
+max_concurrency = 4
+# format and quality of the images we upload
+image_format = "jpg"
+image_quality = 90
+# background uploads and where images wait when the uplink is down
+upload_workers = 2
+spool_dir = "/tmp/spool"
+spool_limit = 500
+# seconds over which messages of a camera are coalesced, 0 sends every message on its own
+batch_window = 0
+# port of the prometheus /metrics endpoint, 0 turns it off
+metrics_port = 9110
+# capture every camera in a process of its own
+capture_processes = False
+# zones are checked on the edge, "overlap" or "foot" (bottom center of the box)
+zone_mode = "overlap"
+# what goes upstream once zones are set: "detections" (boxes and counts) or "zones" (counts only)
+zone_telemetry = "detections"
+
+event_loop = None
+twin_patch_event = None
+
+# running pipeline of each enabled camera: its settings, video stream, stages, task and stop event
+camera_sources = dict()
+# uploader and executor the pipelines share
+pipeline_services = {'uploader': None, 'executor': None}
+# settings that swap the shared services, restart every pipeline but not the streams
+service_settings = ["blob", "upload_workers", "spool_dir", "spool_limit", "max_concurrency"]
+# settings that rebuild the zones of every camera
+zone_settings = ["zones", "zone_mode"]
+# settings only read when the module starts
+startup_settings = ["shared_memory", "shared_memory_slots", "batch_window", "metrics_port"]
+
+# one pooled connection to each detector we talk to
+detector_clients = dict()
+detector_clients_lock = threading.Lock()
+# times we hand a frame over again when its shared memory slot got overwritten
+shared_memory_resends = 3
+
+def merge_twin_patch(desired, patch):
+  '''
+  Applies a desired properties patch the way IoT Hub does:
+  objects are merged, null removes a property
+  '''
+  merged = dict(desired)
+
+  for key, value in patch.items():
+    if key.startswith('$'):
+      continue
+
+    if value is None:
+      merged.pop(key, None)
+    elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+      merged[key] = merge_twin_patch(merged[key], value)
+    else:
+      merged[key] = value
+
+  return merged
 
 def parse_twin(data):
-  global camera_config, received_twin_patch
+  '''
+  data: the full twin, or a desired properties patch
+  '''
+  global camera_config, twin_desired
 
   logging.info(f"Retrieved updated properties: {data}")
-  logging.info(data)
 
   if 'desired' in data:
-    data = data['desired']
+    data = {key: value for key, value in data['desired'].items() if not key.startswith('$')}
+  else:
+    data = merge_twin_patch(twin_desired, data)
+  twin_desired = data
 
   if "cameras" in data:
     cams = data["cameras"].copy()
@@ -46,25 +123,40 @@ def parse_twin(data):
   camera_config["cameras"] = cams.copy()
   camera_config["blob"] = blob
   camera_config["shared_memory"] = data["shared_memory"]  if  "shared_memory" in data else False
+  camera_config["shared_memory_slots"] = int(data["shared_memory_slots"]) if "shared_memory_slots" in data else shared_memory_slots
+  camera_config["max_concurrency"] = int(data["max_concurrency"]) if "max_concurrency" in data else max_concurrency
+  camera_config["image_format"] = data["image_format"] if "image_format" in data else image_format
+  camera_config["image_quality"] = int(data["image_quality"]) if "image_quality" in data else image_quality
+  camera_config["upload_workers"] = int(data["upload_workers"]) if "upload_workers" in data else upload_workers
+  camera_config["spool_dir"] = data["spool_dir"] if "spool_dir" in data else spool_dir
+  camera_config["spool_limit"] = int(data["spool_limit"]) if "spool_limit" in data else spool_limit
+  camera_config["batch_window"] = float(data["batch_window"]) if "batch_window" in data else batch_window
+  camera_config["metrics_port"] = int(data["metrics_port"]) if "metrics_port" in data else metrics_port
+  camera_config["capture_processes"] = data["capture_processes"] if "capture_processes" in data else capture_processes
+  camera_config["zones"] = data["zones"] if "zones" in data else []
+  camera_config["zone_mode"] = data["zone_mode"] if "zone_mode" in data else zone_mode
+  camera_config["zone_telemetry"] = data["zone_telemetry"] if "zone_telemetry" in data else zone_telemetry
 
   logging.info(f"config set: {camera_config}")
-  received_twin_patch = False
 
 def module_twin_callback(client):
 
-  global twin_patch, received_twin_patch
-
   while True:
     # for debugging try and establish a connection
     # otherwise we don't care. If it can't connect let iotedge restart it
     twin_patch = client.receive_twin_desired_properties_patch()
-    received_twin_patch = True
+    with twin_patches_lock:
+      twin_patches.append(twin_patch)
+
+    # wake up the camera scheduler
+    if event_loop is not None:
+      event_loop.call_soon_threadsafe(twin_patch_event.set)
 
 def main():
   global camera_config, shared_memory
   
   # Shared memory
-  fd = None
+  shared_ring = None
 
   messenger = IoTInferenceMessenger()
   client = messenger.client
@@ -86,150 +178,465 @@ def main():
 
   logging.info("Created camera configuration from twin")
 
+  # the endpoint lives as long as the module, a port change needs a restart
+  camera_metrics.start_metrics_server(camera_config["metrics_port"])
+
   if camera_config["shared_memory"]:
-    fd = open(f'/dev/shm/{shared_memory_name}', 'wb+')
-    fd.write(bytearray(shared_memory_size))
-    shared_memory = mmap.mmap(fd.fileno(), shared_memory_size, mmap.MAP_SHARED, mmap.PROT_WRITE)
+    shared_memory = SharedMemoryManager(shared_memory_name, shared_memory_size, create=True)
+    shared_ring = shared_memory.GetRing(camera_config["shared_memory_slots"])
     logging.info("Using shared memory!")
-    
-  while True:
-    spin_camera_loop(messenger, fd)
-    parse_twin(twin_patch)
-
-def spin_camera_loop(messenger, shared_mem_file):
-  
-  intervals_per_cam = dict()
-
-  if camera_config["blob"] is not None:
-    blob_service_client = BlobServiceClient.from_connection_string(camera_config["blob"])
-    logging.info(f"Created blob service client: {blob_service_client.account_name}")
-
-  while not received_twin_patch:
-
-    for key, cam in camera_config["cameras"].items():
 
-      if not cam["enabled"]:
-          continue
-
-      curtime = time.time()
-      
-      if key not in intervals_per_cam:
-        intervals_per_cam[key] = dict()
-        current_source = intervals_per_cam[key]
-        current_source['timer'] = 0
-        current_source['rtsp'] = cam['rtsp']
-        current_source['interval'] = float(cam['interval'])
-        current_source['video'] = VideoStream(cam['rtsp'], float(cam['interval']))
-        current_source['video'].start()
-
-      # this will keep track of how long we need to wait between
-      # bursts of activity
-      video_streamer = current_source['video']
-
-      # not enough time has passed since the last collection
-      if curtime - current_source['timer'] < float(cam['interval']):
-          continue
-
-      current_source['timer'] = curtime
-
-      # block until we get something
-      frame_id, img = video_streamer.get_frame_with_id()
-      if img is None:
-        logging.warn("No frame retrieved. Is video running?")
-        continue
+  if camera_config["batch_window"] > 0:
+    messenger = BatchingIoTMessenger(client, camera_config["batch_window"])
+    logging.info(f"Batching messages over {camera_config['batch_window']} sec")
+    
+  # get_event_loop rather than asyncio.run, the opencv base image runs python 3.6
+  loop = asyncio.get_event_loop()
+  loop.run_until_complete(schedule_cameras(messenger, shared_ring))
 
-      logging.info(f"Grabbed frame {frame_id} from {cam['rtsp']}")
+async def schedule_cameras(messenger, shared_ring):
+  global event_loop, twin_patch_event
 
-      camId = f"{cam['space']}/{key}"
+  event_loop = asyncio.get_event_loop()
+  twin_patch_event = asyncio.Event()
+  running_config = None
 
-      # send to blob storage and retrieve the timestamp by which we will identify the video
-      curtimename = None
-      perf = None
-      if camera_config["blob"] is not None:
-          start_upload = time.time()
-          curtimename, _ = send_img_to_blob(blob_service_client, img, camId)
-          total_upload = time.time() - start_upload
-          perf = {"upload": total_upload}
+  while True:
+    await reconfigure(running_config, messenger, shared_ring)
+    running_config = camera_config
+
+    # the patch may have come in before we started listening
+    with twin_patches_lock:
+      pending = len(twin_patches) > 0
+    if not pending:
+      await twin_patch_event.wait()
+    twin_patch_event.clear()
+
+    with twin_patches_lock:
+      patches = twin_patches.copy()
+      twin_patches.clear()
+
+    for patch in patches:
+      parse_twin(patch)
+
+async def reconfigure(old_config, messenger, shared_ring):
+  '''
+  Brings the running pipelines in line with camera_config. Only cameras whose settings changed
+  are touched, the others keep streaming. old_config: what the pipelines run with, None at start
+  '''
+  old_config = old_config if old_config is not None else dict()
+  # stopping threads and processes blocks, keep it off the loop so the other cameras keep running
+  loop = asyncio.get_event_loop()
+
+  for setting in startup_settings:
+    if setting in old_config and old_config[setting] != camera_config[setting]:
+      logging.warning(f"{setting} changed to {camera_config[setting]}, takes a module restart")
+
+  services_changed = any(old_config.get(setting) != camera_config[setting] for setting in service_settings)
+  zones_changed = any(old_config.get(setting) != camera_config[setting] for setting in zone_settings)
+  # moves the cameras that do not set "capture_process" themselves in or out of a capture process
+  capture_changed = old_config.get("capture_processes", capture_processes) != camera_config["capture_processes"]
+  if capture_changed:
+    logging.info(f"capture_processes changed to {camera_config['capture_processes']}, restarting the streams that follow it")
+
+  # every pipeline holds on to the uploader and the executor, they all pause while we swap them
+  if services_changed:
+    await asyncio.gather(*[stop_camera_task(source) for source in camera_sources.values()])
+    await loop.run_in_executor(None, update_services, old_config)
+
+  cameras = {key: cam for key, cam in camera_config["cameras"].items() if cam["enabled"]}
+
+  for key in list(camera_sources.keys()):
+    if key not in cameras:
+      await stop_camera_task(camera_sources[key])
+      await loop.run_in_executor(None, camera_sources.pop(key)['video'].stop)
+      logging.info(f"Removed camera {key}")
+
+  for key, cam in cameras.items():
+    source = camera_sources.get(key)
+
+    if source is None:
+      camera_sources[key] = source = dict()
+      source['video'] = await loop.run_in_executor(None, start_video_stream, key, cam)
+      source['task'] = None
+      create_stages(source, cam)
+      logging.info(f"Added camera {key}")
+
+    elif source['cam'] != cam or (capture_changed and 'capture_process' not in cam):
+      await stop_camera_task(source)
+      await loop.run_in_executor(None, update_video_stream, key, source, cam)
+      create_stages(source, cam)
+      logging.info(f"Updated camera {key}")
+
+    elif zones_changed:
+      await stop_camera_task(source)
+      source['zones'] = create_zone_occupancy(cam)
+
+    if source['task'] is None:
+      start_camera_task(key, source, messenger, shared_ring)
+
+  camera_metrics.pipeline_collector.track({key: source['video'] for key, source in camera_sources.items()},
+                                          pipeline_services['uploader'], messenger, shared_ring)
+
+def update_services(old_config):
+  '''
+  Swaps the uploader and the executor whose settings changed, camera tasks have to be stopped
+  '''
+  if any(old_config.get(setting) != camera_config[setting] for setting in ["blob", "upload_workers", "spool_dir", "spool_limit"]):
+    # whatever did not make it out yet waits in the spool
+    if pipeline_services['uploader'] is not None:
+      pipeline_services['uploader'].stop()
+    pipeline_services['uploader'] = create_uploader()
+
+  if old_config.get("max_concurrency") != camera_config["max_concurrency"]:
+    if pipeline_services['executor'] is not None:
+      pipeline_services['executor'].shutdown()
+
+    # the blocking part of the pipelines runs here, which bounds
+    # the number of cameras doing work at the same time
+    pipeline_services['executor'] = ThreadPoolExecutor(max_workers=camera_config["max_concurrency"])
+
+def create_uploader():
+  if camera_config["blob"] is None:
+    return None
+
+  blob_service_client = BlobServiceClient.from_connection_string(camera_config["blob"])
+  logging.info(f"Created blob service client: {blob_service_client.account_name}")
+
+  return BlobUploader(blob_service_client, workers=camera_config["upload_workers"],
+                      spool_dir=camera_config["spool_dir"], spool_limit=camera_config["spool_limit"])
+
+def start_camera_task(key, source, messenger, shared_ring):
+  source['stop'] = asyncio.Event()
+  source['task'] = asyncio.get_event_loop().create_task(
+    run_camera(key, source['cam'], source, messenger, pipeline_services['uploader'], shared_ring,
+               pipeline_services['executor'], source['stop']))
+
+async def stop_camera_task(source):
+  '''
+  Lets the pipeline finish what it is doing, the stream keeps running
+  '''
+  if source['task'] is None:
+    return
+
+  source['stop'].set()
+  await asyncio.gather(source['task'], return_exceptions=True)
+  source['task'] = None
+
+def create_stages(source, cam):
+  source['cam'] = cam
+  source['rtsp'] = cam['rtsp']
+  source['interval'] = float(cam['interval'])
+  source['motion'] = create_motion_gate(cam)
+  source['tracker'] = create_tracker(cam)
+  source['zones'] = create_zone_occupancy(cam)
+  source['resizer'] = create_resizer(cam)
+
+def update_video_stream(key, source, cam):
+  '''
+  Reconnects only when the source changed, a new interval is picked up by the running stream
+  '''
+  video = source['video']
+  old_cam = source['cam']
+
+  if old_cam.get('capture') != cam.get('capture') or isinstance(video, ProcessVideoStream) != uses_capture_process(cam):
+    video.stop()
+    source['video'] = start_video_stream(key, cam)
+  elif old_cam['rtsp'] != cam['rtsp']:
+    video.reset(cam['rtsp'], float(cam['interval']))
+  elif float(old_cam['interval']) != float(cam['interval']):
+    video.set_interval(float(cam['interval']))
+
+def uses_capture_process(cam):
+  '''
+  "capture_process" in the camera twin settings overrides the module wide "capture_processes"
+  '''
+  return cam.get('capture_process', camera_config["capture_processes"])
+
+def create_video_stream(key, cam):
+  if uses_capture_process(cam):
+    return ProcessVideoStream(key, cam['rtsp'], float(cam['interval']), capture_options=cam.get('capture'))
+
+  return VideoStream(cam['rtsp'], float(cam['interval']), capture_options=cam.get('capture'))
+
+def start_video_stream(key, cam):
+  video = create_video_stream(key, cam)
+  video.start()
+  return video
+
+def create_motion_gate(cam):
+  '''
+  Camera twin settings: "motion" turns gating on, "motion_threshold" (0-255),
+  "motion_min_area" (fraction of the frame) and "motion_refresh" (sec) tune it
+  '''
+  if not cam.get('motion', False):
+    return None
+
+  return MotionGate(threshold=int(cam.get('motion_threshold', 25)),
+                    min_area=float(cam.get('motion_min_area', 0.005)),
+                    refresh_interval=float(cam.get('motion_refresh', 30)))
+
+def create_tracker(cam):
+  '''
+  Camera twin settings: "tracking" turns it on, "detect_every" runs the detector on every Nth frame,
+  "track_iou" (match overlap), "track_max_age" and "track_min_hits" (detection rounds) tune it
+  '''
+  if not cam.get('tracking', False):
+    return None
+
+  return ObjectTracker(iou_threshold=float(cam.get('track_iou', 0.3)),
+                       max_age=int(cam.get('track_max_age', 3)),
+                       min_hits=int(cam.get('track_min_hits', 2)),
+                       detect_every=int(cam.get('detect_every', 1)))
+
+def create_zone_occupancy(cam):
+  '''
+  Zones of the camera ("zones" in its twin settings), the module wide zones otherwise
+  '''
+  zones = cam.get('zones', camera_config["zones"])
+  if len(zones) == 0:
+    return None
+
+  return ZoneOccupancy(zones, camera_config["zone_mode"])
+
+def create_resizer(cam):
+  '''
+  Camera twin settings: "tensor_size" ([width, height] of the model input) has the camera send
+  model sized frames, "tensor_layout" "chw" has it send them channel first.
+  Over shared memory such frames are inferred by the OpenVINO detector right where they are
+  '''
+  if 'tensor_size' not in cam:
+    return FrameResizer(width=400)
+
+  width, height = cam['tensor_size']
+  return FrameResizer(int(width), int(height), cam.get('tensor_layout', "hwc"))
+
+async def run_camera(key, cam, source, messenger, uploader, shared_ring, pipeline_executor, stop_cameras):
+  '''
+  Wakes up every camera interval and runs capture -> upload -> infer -> publish.
+  source holds the stages of the camera: video, motion, tracker, zones and resizer
+  '''
+  loop = asyncio.get_event_loop()
+  interval = float(cam['interval'])
+  next_tick = loop.time()
+
+  while not stop_cameras.is_set():
+    try:
+      await loop.run_in_executor(pipeline_executor, process_camera_frame,
+                                 key, cam, source, messenger, uploader, shared_ring)
+    except Exception as e:
+      logging.error(f"Pipeline for {key} failed: {e}")
 
-      detections = []
-      
-      if cam['detector'] is not None and cam['inference'] is not None and cam['inference']:
-        start_inf = time.time()
-        res = infer(cam['detector'], img, frame_id, curtimename, shared_mem_file)
-        total_inf = time.time() - start_inf
+    # if the pipeline overran, skip the ticks we missed rather than bursting
+    now = loop.time()
+    next_tick += interval
+    if next_tick < now:
+      next_tick += math.ceil((now - next_tick) / interval) * interval
 
+    try:
+      await asyncio.wait_for(stop_cameras.wait(), next_tick - now)
+    except asyncio.TimeoutError:
+      pass
+
+def process_camera_frame(key, cam, source, messenger, uploader, shared_ring):
+
+  video_streamer = source['video']
+  motion_gate = source['motion']
+  tracker = source['tracker']
+  zone_occupancy = source['zones']
+
+  # grab whatever is latest
+  frame_id, img, capture_time = video_streamer.get_frame_with_timestamp()
+  if img is None:
+    logging.warn("No frame retrieved. Is video running?")
+    return
+
+  logging.info(f"Grabbed frame {frame_id} from {cam['rtsp']} ({video_streamer.frames_dropped} dropped so far)")
+
+  camId = f"{cam['space']}/{key}"
+
+  # how stale the frame is by the time we pick it up
+  perf = {"framelag": time.time() - capture_time}
+  camera_metrics.frame_lag_seconds.labels(key).observe(perf["framelag"])
+
+  # send to blob storage and retrieve the timestamp by which we will identify the video
+  curtimename = None
+  if uploader is not None:
+      start_encode = time.time()
+      img_bytes = encode_image(img, camera_config["image_format"], camera_config["image_quality"])
+      perf["encode"] = time.time() - start_encode
+
+      # the upload itself happens in the background, report the latest one that went through
+      start_upload = time.time()
+      curtimename, _ = send_img_to_blob(uploader, img_bytes, camId, camera_config["image_format"])
+      perf["uploadenqueue"] = time.time() - start_upload
+      if uploader.last_upload_time is not None:
+        perf["upload"] = uploader.last_upload_time
+      perf["uploadqueue"] = uploader.queue_depth()
+
+  if isinstance(messenger, BatchingIoTMessenger):
+    perf["messagequeue"] = messenger.queue_depth()
+    perf["messagesend"] = messenger.last_send_latency
+
+  detections = []
+  track_events = []
+  
+  if cam['detector'] is not None and cam['inference'] is not None and cam['inference']:
+
+    # in between detector frames the tracker moves the objects along
+    if tracker is not None and not tracker.needs_detection():
+      detections = tracker.predict(capture_time)
+      perf["tracked"] = len(detections)
+
+    # nothing moved since the last inference, the detections still hold
+    elif motion_gate is not None and not motion_gate.should_infer(img, capture_time):
+      detections = motion_gate.last_detections
+      perf["motionskip"] = motion_gate.skipped
+      camera_metrics.inference_skipped.labels(key).inc()
+    else:
+      start_inf = time.time()
+      res = infer(cam['detector'], source['resizer'].resize(img), frame_id, curtimename, shared_ring,
+                  cam.get('transport', 'binary'), source['resizer'].layout)
+      total_inf = time.time() - start_inf
+
+      if res is not None:
         detections = res["detections"]
         perf = {**perf, **res["perf"]}
         perf["imgencode"] = total_inf - perf["imgprep"] - perf["detection"]
         logging.info(f"perf: {perf}")
 
-      # message the image capture upstream
-      if curtimename is not None:
-        messenger.send_image_and_detection(camId, curtimename, frame_id, detections)
-        messenger.send_perf(camId, curtimename, frame_id, perf)
-        logging.info(f"Notified of image upload: {cam['rtsp']} to {cam['space']}")
-
-  # shutdown current video captures
-  for key, cam in intervals_per_cam.items():
-    cam['video'].stop()
+        if tracker is not None:
+          detections, track_events = tracker.update(detections, capture_time)
+
+      if motion_gate is not None:
+        if res is not None:
+          motion_gate.update(detections)
+        else:
+          motion_gate.reset()
+
+  zone_counts = None
+  if zone_occupancy is not None:
+    zone_counts, in_zones, zone_events = zone_occupancy.update(detections, capture_time)
+
+  # message the image capture upstream
+  if curtimename is not None:
+    image_format = camera_config["image_format"]
+    if zone_counts is None or camera_config["zone_telemetry"] != "zones":
+      messenger.send_image_and_detection(camId, curtimename, frame_id, detections, image_format)
+    if zone_counts is not None:
+      messenger.send_zone_counts(camId, curtimename, frame_id, zone_counts, in_zones, len(detections), zone_events,
+                                 image_format)
+    messenger.send_perf(camId, curtimename, frame_id, perf, image_format)
+    if len(track_events) > 0:
+      messenger.send_track_events(camId, curtimename, frame_id, track_events, image_format)
+    logging.info(f"Notified of image upload: {cam['rtsp']} to {cam['space']}")
+
+def infer(detector, im, frame_id, img_name, shared_ring = None, transport = "binary", layout = "hwc"):
+  '''
+  Sends the frame, already resized for the detector, through shared memory if we have it,
+  otherwise as raw bytes or, for older detectors, as a json list (transport = "json").
+  layout "chw" tells the detector the frame is a channel first model input
+  '''
 
-def infer(detector, img, frame_id, img_name, shared_file = None):
+  parameters = dict()
+  headers = {'Content-Type': "application/json"}
 
-  im = imutils.resize(img, width=400)
-  if shared_file is not None:
-    shared_file.seek(0)
-    shared_file.write(im.tobytes())
+  if layout == "chw":
+    parameters["layout"] = layout
 
+  if shared_ring is not None:
+    parameters["shared"] = shared_memory_name
     data = json.dumps({"frameId": frame_id, "image_name": img_name})
-  else:  
+  elif transport == "json":
     data = json.dumps({"frameId": frame_id, "image_name": img_name, "img": im.tolist()})
-  
-  headers = {'Content-Type': "application/json"}
-  parameters = dict()
-  
-  if shared_file is not None:
-    parameters["shared"] = shared_memory_name
-    parameters["size"] = f'{im.shape[0]},{im.shape[1]},{im.shape[2]}'
+  else:
+    # frame layout travels in the headers, the body is the raw pixel buffer
+    headers = {'Content-Type': "application/octet-stream",
+               'X-Frame-Shape': ','.join(map(str, im.shape)),
+               'X-Frame-Dtype': str(im.dtype),
+               'X-Frame-Id': str(frame_id)}
+    if img_name is not None:
+      headers['X-Image-Name'] = img_name
+
+    data = im.tobytes()
 
-  # wait for the detector to start
-  for _ in range(24):
+  client = get_detector_client(detector)
+  start = time.time()
+
+  for _ in range(shared_memory_resends):
     try:
-      resp = requests.post(detector, data, headers=headers, params = parameters)
+      if shared_ring is not None:
+        # the detector picks the frame up from the slot as long as
+        # its sequence number has not moved on
+        parameters["slot"], parameters["seq"] = shared_ring.WriteFrame(im, frame_id)
+
+        with camera_metrics.shm_slots_in_use.track_inprogress():
+          resp = client.post(data, headers=headers, params = parameters)
+      else:
+        resp = client.post(data, headers=headers, params = parameters)
+
+      # other cameras have cycled through the ring before the detector
+      # got to our slot, hand the frame over again
+      if resp.status_code == 409:
+        logging.warning(f"Shared memory slot {parameters['slot']} was overwritten, resending")
+        camera_metrics.shm_resends.inc()
+        continue
+
       resp.raise_for_status()
-      result = resp.json()
+      res = resp.json()
+
+      camera_metrics.inference_seconds.labels(detector).observe(time.time() - start)
+      return res
+
+    except CircuitOpenError:
+      # detector is down or still starting, skip inference for this frame
+      break
+    except (requests.RequestException, ValueError) as e:
+      logging.warning(f"Inference failed on {detector}: {e}")
+      break
+
+  camera_metrics.inference_failures.labels(detector).inc()
+  return None
+
+def get_detector_client(detector):
+  with detector_clients_lock:
+    if detector not in detector_clients:
+      detector_clients[detector] = DetectorClient(detector, pool_size=camera_config["max_concurrency"])
+    return detector_clients[detector]
 
-      return result
-    except:
-        time.sleep(10)
-  
 def report(messenger, cam, classes, scores, boxes, curtimename, proc_time):
   messenger.send_upload(cam, len(scores), curtimename, proc_time)
   time.sleep(0.01)
   messenger.send_inference(cam, classes, scores, boxes, curtimename)
 
 
-def get_image_local_name(curtime):
-  return os.path.abspath(curtime.strftime("%Y_%m_%d_%H_%M_%S_%f") + ".jpg")
+def encode_image(img, img_format="jpg", quality=90):
+  '''
+  Compresses the frame in memory, returns the encoded bytes
+  '''
+  if img_format == "jpg":
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+  elif img_format == "webp":
+    params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+  else:
+    raise ValueError(f"Unsupported image format: {img_format}")
 
+  res, buffer = cv2.imencode(f".{img_format}", img, params)
+  if not res:
+    raise ValueError(f"Could not encode image as {img_format}")
 
-def send_img_to_blob(blob_service_client, img, camId):
+  return buffer.tobytes()
+
+def send_img_to_blob(uploader, img_bytes, camId, img_format="jpg"):
 
   curtime = datetime.datetime.utcnow()
   name = curtime.isoformat() + "Z"
 
-  # used to write temporary local file
-  # because that's how the SDK works.
-  # the file name is used upload to blob
-  local_name = get_image_local_name(curtime)
   day = curtime.strftime("%Y-%m-%d")
+  content_type = "image/jpeg" if img_format == "jpg" else f"image/{img_format}"
 
-  blob_client = blob_service_client.get_blob_client("still-images", f"{camId}/{day}/{name}.jpg")
-  cv2.imwrite(local_name, img)
-
-  with open(local_name, "rb") as data:
-    blob_client.upload_blob(data)
+  uploader.upload(f"{camId}/{day}/{name}.{img_format}", img_bytes, content_type)
 
-  os.remove(local_name)
   return name, f"{camId}/{day}"
 
 if __name__ == "__main__":
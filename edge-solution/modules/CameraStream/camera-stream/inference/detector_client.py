@@ -0,0 +1,102 @@
+import logging, time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+class CircuitOpenError(Exception):
+  '''
+  The detector failed too often recently, we are not calling it for now
+  '''
+  pass
+
+class DetectorClient:
+  '''
+  Keeps a pool of keep-alive connections to a detector and stops calling it
+  for a while once it keeps failing (circuit breaker)
+  '''
+
+  def __init__(self, url, pool_size=4, connect_timeout=2., read_timeout=10., failure_threshold=3, reset_timeout=30.):
+    '''
+    Parameters:
+      url: detector endpoint
+      pool_size: connections kept open to the detector
+      connect_timeout, read_timeout: request timeouts (sec)
+      failure_threshold: consecutive failures that open the circuit
+      reset_timeout: how long the circuit stays open before we try the detector again (sec)
+    '''
+    self.url = url
+    self.timeout = (connect_timeout, read_timeout)
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+    self.lock = threading.Lock()
+    self.failures = 0
+    self.opened_at = None
+    self.probing = False
+
+  @property
+  def is_open(self):
+    return self.opened_at is not None
+
+  def allow_request(self):
+    with self.lock:
+      if self.opened_at is None:
+        return True
+
+      # half open: let a single request through to see if the detector is back
+      if not self.probing and time.time() - self.opened_at >= self.reset_timeout:
+        self.probing = True
+        return True
+
+      return False
+
+  def record_success(self):
+    with self.lock:
+      if self.opened_at is not None:
+        logging.info(f"Detector {self.url} is back")
+
+      self.failures = 0
+      self.opened_at = None
+      self.probing = False
+
+  def record_failure(self):
+    with self.lock:
+      self.failures += 1
+      self.probing = False
+
+      if self.opened_at is not None or self.failures >= self.failure_threshold:
+        if self.opened_at is None:
+          logging.warning(f"Detector {self.url} failed {self.failures} times, pausing calls for {self.reset_timeout} sec")
+        self.opened_at = time.time()
+
+  def post(self, data, headers=None, params=None):
+    '''
+    Posts to the detector. Raises CircuitOpenError without calling it if the circuit is open
+    '''
+    if not self.allow_request():
+      raise CircuitOpenError(f"Detector {self.url} is unavailable")
+
+    try:
+      resp = self.session.post(self.url, data=data, headers=headers, params=params, timeout=self.timeout)
+    except requests.RequestException:
+      self.record_failure()
+      raise
+
+    # server side trouble counts against the detector, anything else is on us
+    if resp.status_code >= 500:
+      self.record_failure()
+    else:
+      self.record_success()
+
+    return resp
+
+  def close(self):
+    self.session.close()
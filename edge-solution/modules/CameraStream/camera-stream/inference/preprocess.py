@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+
+class FrameResizer:
+  '''
+  Resizes the frames of one camera for the detector into buffers reused across frames.
+
+  By default frames keep their aspect ratio and are scaled to width, the detector resizes them
+  to the model input. With height set they go straight to the model size, and with layout "chw"
+  they are also written channel first, so the detector copies them into its input as they are.
+  '''
+
+  def __init__(self, width=400, height=None, layout="hwc"):
+    '''
+    Parameters:
+      width: width of the frames we send
+      height: model input height, None to keep the aspect ratio of the camera
+      layout: "hwc" or "chw", "chw" needs the height
+    '''
+    if layout not in ["hwc", "chw"]:
+      raise ValueError(f"Unknown layout: {layout}")
+    if layout == "chw" and height is None:
+      raise ValueError("Channel first frames have to be model sized, set the height")
+
+    self.width = width
+    self.height = height
+    self.layout = layout
+
+    self.resized = None
+    self.tensor = None
+
+  def size_for(self, frame):
+    if self.height is not None:
+      return self.width, self.height
+
+    h, w = frame.shape[:2]
+    return self.width, int(h * self.width / float(w))
+
+  def resize(self, frame):
+    '''
+    Returns the resized frame, the buffer is overwritten by the next call
+    '''
+    width, height = self.size_for(frame)
+
+    # the capture backend already decoded at this size
+    if frame.shape[:2] == (height, width) and self.layout == "hwc":
+      return frame
+
+    if self.resized is None or self.resized.shape != (height, width) + frame.shape[2:]:
+      self.resized = np.empty((height, width) + frame.shape[2:], dtype=frame.dtype)
+      self.tensor = np.empty((self.resized.shape[2], height, width), dtype=frame.dtype) if self.layout == "chw" else None
+
+    cv2.resize(frame, (width, height), dst=self.resized, interpolation=cv2.INTER_AREA)
+
+    if self.layout == "hwc":
+      return self.resized
+
+    self.tensor[...] = self.resized.transpose((2, 0, 1))
+    return self.tensor
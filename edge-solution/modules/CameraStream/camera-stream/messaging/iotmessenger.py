@@ -4,6 +4,10 @@ from azure.iot.device import IoTHubModuleClient, Message
 
 import logging
 import json
+import time
+import threading
+from queue import Queue, Full, Empty
+from metrics import camera_metrics
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
@@ -11,8 +15,8 @@ logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt=
 class IoTMessaging:
   timeout = 10000
 
-  def __init__(self):
-    self.client = IoTHubModuleClient.create_from_edge_environment()
+  def __init__(self, client=None):
+    self.client = client if client is not None else IoTHubModuleClient.create_from_edge_environment()
 
     # set the time until a message times out
     self.output_queue = "iotHub"
@@ -21,11 +25,13 @@ class IoTMessaging:
 
     message = Message(json.dumps(body))
     message.custom_properties["type"] = msg_type
-    self.client.send_message(message)
+
+    with camera_metrics.iot_send_seconds.labels(msg_type).time():
+      self.client.send_message(message)
 
 class IoTInferenceMessenger(IoTMessaging):
-  def __init__(self):
-    super().__init__()
+  def __init__(self, client=None):
+    super().__init__(client)
     self.context = 0
 
   def send_inference(self, camId, classes, scores, bboxes, curtimename):
@@ -52,13 +58,146 @@ class IoTInferenceMessenger(IoTMessaging):
       self.send_event(body)
       logging.info(f"Sent: {body}")
 
-  def send_image_and_detection(self, camId, imgname, frame_id, detections):
-      body = {"cameraId": camId, "image_name": imgname, "frameId": frame_id, "detections": detections}
+  # image_format tells the dashboard the extension of the image blob
+  def send_image_and_detection(self, camId, imgname, frame_id, detections, image_format="jpg"):
+      body = {"cameraId": camId, "image_name": imgname, "image_format": image_format, "frameId": frame_id,
+              "detections": detections}
 
       self.send_event(body, "image")
       logging.info(f"Sent image: {imgname}")
 
-  def send_perf(self, camId, imgname, frame_id, perf):
-      body = {"cameraId": camId, "image_name": imgname, "frameId": frame_id, "perf": perf}
+  def send_perf(self, camId, imgname, frame_id, perf, image_format="jpg"):
+      body = {"cameraId": camId, "image_name": imgname, "image_format": image_format, "frameId": frame_id, "perf": perf}
 
       self.send_event(body, "perf")
+
+  def send_zone_counts(self, camId, imgname, frame_id, counts, collisions, detection_count, events, image_format="jpg"):
+      body = {"cameraId": camId, "image_name": imgname, "image_format": image_format, "frameId": frame_id, "zones": counts,
+              "collisions": collisions, "detectionCount": detection_count, "events": events}
+
+      self.send_event(body, "zones")
+
+  def send_track_events(self, camId, imgname, frame_id, events, image_format="jpg"):
+      body = {"cameraId": camId, "image_name": imgname, "image_format": image_format, "frameId": frame_id, "events": events}
+
+      self.send_event(body, "track")
+      logging.info(f"Sent {len(events)} track events for {camId}")
+
+class BatchingIoTMessenger(IoTInferenceMessenger):
+  '''
+  Coalesces the messages of each camera over a time window into a single
+  "batch" message and sends them from a background thread.
+  Batch body: {"cameraId": ..., "messages": [{"type": ..., "body": ...}, ...]}
+  '''
+  # IoT Hub rejects messages over 256 KB, leave room for properties
+  max_batch_size = 255 * 1024
+  # list fields a message too big for IoT Hub is split along
+  split_fields = ["detections", "events"]
+
+  def __init__(self, client=None, window=1., max_queue=10000):
+    '''
+    Parameters:
+      client: IoTHubModuleClient to share, a new one is created if None
+      window: how long messages of a camera are collected before they are sent (sec)
+      max_queue: messages waiting to be batched before new ones are dropped
+    '''
+    super().__init__(client)
+
+    self.window = window
+    self.outgoing = Queue(max_queue)
+    # camera id -> batch being collected
+    self.batches = dict()
+
+    self.sent = 0
+    self.dropped = 0
+    self.oversized = 0
+    self.last_send_latency = None
+
+    self.sender = threading.Thread(target=self.run_sender)
+    self.sender.daemon = True
+    self.sender.start()
+
+  def send_event(self, body, msg_type="message"):
+    try:
+      self.outgoing.put_nowait((msg_type, body))
+    except Full:
+      self.dropped += 1
+
+  def queue_depth(self):
+    return self.outgoing.qsize() + sum(len(batch["messages"]) for batch in list(self.batches.values()))
+
+  def run_sender(self):
+    while True:
+      # wake up in time for the oldest batch
+      now = time.time()
+      deadlines = [batch["started"] + self.window for batch in list(self.batches.values())]
+      timeout = max(0, min(deadlines) - now) if len(deadlines) > 0 else self.window
+
+      try:
+        msg_type, body = self.outgoing.get(timeout=timeout)
+        self.add_to_batch(msg_type, body)
+      except Empty:
+        pass
+
+      now = time.time()
+      for camId in [camId for camId, batch in self.batches.items() if now - batch["started"] >= self.window]:
+        self.flush(camId)
+
+  def add_to_batch(self, msg_type, body):
+    camId = body.get("cameraId", "")
+    entry = json.dumps({"type": msg_type, "body": body})
+
+    # does not fit into a batch: split it up, IoT Hub would reject it as it is
+    if len(entry) + len(json.dumps(camId)) + 64 > self.max_batch_size:
+      for part in self.split_message(msg_type, body):
+        self.add_to_batch(msg_type, part)
+      return
+
+    batch = self.batches.get(camId)
+    if batch is not None and batch["size"] + len(entry) > self.max_batch_size:
+      self.flush(camId)
+      batch = None
+
+    if batch is None:
+      batch = {"started": time.time(), "messages": [], "size": len(json.dumps(camId)) + 64}
+      self.batches[camId] = batch
+
+    batch["messages"].append(entry)
+    batch["size"] += len(entry) + 1
+
+  def split_message(self, msg_type, body):
+    '''
+    Halves the longest of the split_fields lists, each half goes into a copy of the body.
+    A message that cannot be split is dropped
+    '''
+    field = max([field for field in self.split_fields if len(body.get(field) or []) > 1],
+                key=lambda field: len(body[field]), default=None)
+
+    if field is None:
+      logging.warning(f"Dropped {msg_type} message of {body.get('cameraId', '')}, it is over the IoT Hub size limit")
+      self.oversized += 1
+      camera_metrics.iot_messages_oversized.labels(msg_type).inc()
+      return []
+
+    half = len(body[field]) // 2
+    return [dict(body, **{field: body[field][:half]}), dict(body, **{field: body[field][half:]})]
+
+  def flush(self, camId):
+    batch = self.batches.pop(camId)
+
+    # entries are already serialized, just stitch them together
+    payload = f'{{"cameraId": {json.dumps(camId)}, "messages": [{",".join(batch["messages"])}]}}'
+    self.send_message(payload, "batch")
+
+  def send_message(self, payload, msg_type):
+    message = Message(payload)
+    message.custom_properties["type"] = msg_type
+
+    start = time.time()
+    try:
+      self.client.send_message(message)
+      self.sent += 1
+    except Exception as e:
+      logging.error(f"Could not send {msg_type} message: {e}")
+    self.last_send_latency = time.time() - start
+    camera_metrics.iot_send_seconds.labels(msg_type).observe(self.last_send_latency)
@@ -0,0 +1,92 @@
+import logging
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+# ***********************************************************************************
+# Prometheus metrics, scraped from http://<edge box>:<metrics_port>/metrics
+#
+# Latencies are observed where the work happens. Counts the pipeline objects already
+# keep (frames, queues) are read when we get scraped, see PipelineCollector
+#
+latency_buckets = (.005, .01, .025, .05, .075, .1, .25, .5, 1., 2.5, 5., 10.)
+
+inference_seconds = Histogram("camerastream_inference_seconds", "Round trip of a frame to the detector", ["detector"],
+                              buckets=latency_buckets)
+inference_skipped = Counter("camerastream_inference_skipped_total", "Frames not sent to the detector because nothing moved", ["camera"])
+inference_failures = Counter("camerastream_inference_failures_total", "Frames the detector did not answer", ["detector"])
+frame_lag_seconds = Histogram("camerastream_frame_lag_seconds", "Age of a frame when the pipeline picks it up", ["camera"],
+                              buckets=latency_buckets)
+blob_upload_seconds = Histogram("camerastream_blob_upload_seconds", "Upload time of an image", buckets=latency_buckets)
+blob_upload_failures = Counter("camerastream_blob_upload_failures_total", "Failed image upload attempts")
+iot_send_seconds = Histogram("camerastream_iot_send_seconds", "Time to hand a message to IoT Hub", ["type"],
+                             buckets=latency_buckets)
+iot_messages_oversized = Counter("camerastream_iot_messages_oversized_total", "Messages over the IoT Hub size limit that could not be split, dropped", ["type"])
+shm_slots_in_use = Gauge("camerastream_shm_slots_in_use", "Shared memory slots holding a frame the detector has not answered yet")
+shm_resends = Counter("camerastream_shm_resends_total", "Frames handed over again because their slot was overwritten")
+
+class PipelineCollector:
+  '''
+  Reports the state of the current camera pipelines, they are swapped on every twin update
+  '''
+
+  def __init__(self):
+    self.streams = dict()
+    self.uploader = None
+    self.messenger = None
+    self.shared_ring = None
+
+  def track(self, streams=None, uploader=None, messenger=None, shared_ring=None):
+    '''
+    Parameters:
+      streams: camera id -> VideoStream
+      uploader: BlobUploader or None
+      messenger: IoT messenger, queue depth is reported for BatchingIoTMessenger
+      shared_ring: SharedMemoryRing or None
+    '''
+    self.streams = dict(streams) if streams is not None else dict()
+    self.uploader = uploader
+    self.messenger = messenger
+    self.shared_ring = shared_ring
+
+  def collect(self):
+    captured = CounterMetricFamily("camerastream_frames_captured", "Frames read from the camera", labels=["camera"])
+    dropped = CounterMetricFamily("camerastream_frames_dropped", "Frames replaced by a newer one before the pipeline got to them", labels=["camera"])
+    skipped = CounterMetricFamily("camerastream_frames_skipped", "Frames grabbed but not decoded", labels=["camera"])
+    queued = GaugeMetricFamily("camerastream_frame_queue_depth", "Frames waiting in the VideoStream queue", labels=["camera"])
+
+    for camera, stream in list(self.streams.items()):
+      captured.add_metric([camera], stream.frames_captured)
+      dropped.add_metric([camera], stream.frames_dropped)
+      skipped.add_metric([camera], stream.frames_skipped)
+      queued.add_metric([camera], stream.queue_depth())
+
+    yield from [captured, dropped, skipped, queued]
+
+    uploader = self.uploader
+    if uploader is not None:
+      yield GaugeMetricFamily("camerastream_blob_upload_queue_depth", "Images waiting for upload, spool included", value=uploader.queue_depth())
+      yield CounterMetricFamily("camerastream_blob_uploads_dropped", "Images given up on", value=uploader.dropped)
+
+    messenger = self.messenger
+    if hasattr(messenger, "queue_depth"):
+      yield GaugeMetricFamily("camerastream_iot_queue_depth", "Messages waiting to be sent", value=messenger.queue_depth())
+      yield CounterMetricFamily("camerastream_iot_messages_dropped", "Messages dropped because the queue was full", value=messenger.dropped)
+
+    if self.shared_ring is not None:
+      yield GaugeMetricFamily("camerastream_shm_slots", "Slots in the shared memory ring", value=self.shared_ring.slotCount)
+
+pipeline_collector = PipelineCollector()
+
+def start_metrics_server(port):
+  '''
+  Serves /metrics in a background thread, port 0 turns metrics off
+  '''
+  if port <= 0:
+    return
+
+  REGISTRY.register(pipeline_collector)
+  start_http_server(port)
+  logging.info(f"Serving metrics on port {port}")
@@ -0,0 +1,242 @@
+import os, logging, time, json
+import heapq
+import itertools
+import threading
+from queue import Queue, Full, Empty
+from azure.storage.blob import ContentSettings
+from metrics import camera_metrics
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+class BlobUploader:
+  '''
+  Uploads images to blob storage in the background so capture and inference never wait on the network.
+
+  Fresh images go through an in-memory queue served by a pool of workers.
+  Images whose upload failed, or that arrive while the queue is full, are written to an on-disk spool
+  and retried with exponential backoff. The spool survives restarts and is bounded: once it is full
+  the oldest images are dropped.
+  '''
+
+  def __init__(self, blob_service_client, container="still-images", workers=2, queue_size=32,
+               spool_dir="/tmp/spool", spool_limit=500, max_attempts=10, backoff=1., max_backoff=300.):
+    '''
+    Parameters:
+      blob_service_client: anything with get_blob_client(container, name).upload_blob(data, ...)
+      container: blob container the images go to
+      workers: number of concurrent uploads
+      queue_size: images waiting in memory before we start spooling to disk
+      spool_dir: directory for images waiting to be retried
+      spool_limit: maximum number of images in the spool
+      max_attempts: uploads attempted before an image is dropped
+      backoff, max_backoff: first and longest delay between retries (sec)
+    '''
+
+    self.blob_service_client = blob_service_client
+    self.container = container
+    self.spool_dir = spool_dir
+    self.spool_limit = spool_limit
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+
+    self.pending = Queue(queue_size)
+    self.keep_uploading = True
+
+    # spooled images by retry time: (due time, spool id)
+    self.spool_lock = threading.Condition()
+    self.spool_due = []
+    self.spool_ids = itertools.count()
+
+    self.uploaded = 0
+    self.failed = 0
+    self.dropped = 0
+    self.last_upload_time = None
+
+    os.makedirs(self.spool_dir, exist_ok=True)
+    self.load_spool()
+
+    self.workers = []
+    for _ in range(workers):
+      self.workers.append(self.start_thread(self.upload_pending))
+    self.workers.append(self.start_thread(self.retry_spooled))
+
+  def start_thread(self, target):
+    worker = threading.Thread(target=target)
+    worker.daemon = True
+    worker.start()
+    return worker
+
+  def upload(self, blob_name, data, content_type=None):
+    '''
+    Queues the image for upload, never blocks
+    '''
+    item = {"blob": blob_name, "content_type": content_type, "attempts": 0}
+
+    try:
+      self.pending.put_nowait((item, data))
+    except Full:
+      self.spool(item, data)
+
+  def queue_depth(self):
+    return self.pending.qsize() + len(self.spool_due)
+
+  def stop(self):
+    '''
+    Stops the workers, images not uploaded yet are kept in the spool for the next run
+    '''
+    self.keep_uploading = False
+    with self.spool_lock:
+      self.spool_lock.notify_all()
+
+    for worker in self.workers:
+      worker.join()
+
+    while True:
+      try:
+        item, data = self.pending.get_nowait()
+      except Empty:
+        break
+      self.spool(item, data)
+
+    logging.info(f"Stopped uploading. Uploaded: {self.uploaded}, failed: {self.failed}, dropped: {self.dropped}, spooled: {len(self.spool_due)}")
+
+  def try_upload(self, item, data):
+    item["attempts"] += 1
+
+    try:
+      start = time.time()
+      blob_client = self.blob_service_client.get_blob_client(self.container, item["blob"])
+
+      if item["content_type"] is not None:
+        blob_client.upload_blob(data, overwrite=True, content_settings=ContentSettings(content_type=item["content_type"]))
+      else:
+        blob_client.upload_blob(data, overwrite=True)
+
+      self.last_upload_time = time.time() - start
+      self.uploaded += 1
+      camera_metrics.blob_upload_seconds.observe(self.last_upload_time)
+      return True
+    except Exception as e:
+      self.failed += 1
+      camera_metrics.blob_upload_failures.inc()
+      logging.warning(f"Upload of {item['blob']} failed (attempt {item['attempts']}): {e}")
+      return False
+
+  def upload_pending(self):
+    while self.keep_uploading:
+      try:
+        item, data = self.pending.get(timeout=0.5)
+      except Empty:
+        continue
+
+      if not self.try_upload(item, data):
+        self.spool(item, data)
+
+  def retry_delay(self, attempts):
+    return min(self.max_backoff, self.backoff * 2 ** max(0, attempts - 1))
+
+  # ----------------------------- spool -----------------------------
+
+  def spool_paths(self, spool_id):
+    base = os.path.join(self.spool_dir, spool_id)
+    return f"{base}.bin", f"{base}.json"
+
+  def load_spool(self):
+    '''
+    Picks up images left over from a previous run, they are retried right away
+    '''
+    now = time.time()
+    names = set(os.listdir(self.spool_dir))
+
+    for name in sorted(names):
+      spool_id, ext = os.path.splitext(name)
+      data_name, meta_name = [os.path.basename(path) for path in self.spool_paths(spool_id)]
+
+      if ext == ".json" and data_name in names:
+        heapq.heappush(self.spool_due, (now, spool_id))
+      elif ext != ".bin" or meta_name not in names:
+        # left over from a write that did not complete
+        os.remove(os.path.join(self.spool_dir, name))
+
+    if len(self.spool_due) > 0:
+      logging.info(f"Found {len(self.spool_due)} images waiting for upload in {self.spool_dir}")
+
+  def spool(self, item, data):
+    if item["attempts"] >= self.max_attempts:
+      logging.warning(f"Giving up on {item['blob']} after {item['attempts']} attempts")
+      self.dropped += 1
+      return
+
+    with self.spool_lock:
+      # spool is full: make room by dropping the oldest image
+      while len(self.spool_due) >= self.spool_limit:
+        oldest = min(self.spool_due, key=lambda due: due[1])
+        self.spool_due.remove(oldest)
+        heapq.heapify(self.spool_due)
+        self.remove_spooled(oldest[1])
+        self.dropped += 1
+
+      # ids sort by spool time, time_ns is not there on python 3.6
+      spool_id = f"{int(time.time() * 1e9):020d}-{next(self.spool_ids):06d}"
+      self.write_spooled(spool_id, item, data)
+
+      heapq.heappush(self.spool_due, (time.time() + self.retry_delay(item["attempts"]), spool_id))
+      self.spool_lock.notify()
+
+  def write_spooled(self, spool_id, item, data):
+    data_path, meta_path = self.spool_paths(spool_id)
+
+    with open(data_path, "wb") as f:
+      f.write(data)
+
+    # metadata goes last and atomically, an image without it is incomplete
+    with open(meta_path + ".tmp", "w") as f:
+      json.dump(item, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+  def read_spooled(self, spool_id):
+    data_path, meta_path = self.spool_paths(spool_id)
+
+    with open(meta_path) as f:
+      item = json.load(f)
+    with open(data_path, "rb") as f:
+      data = f.read()
+
+    return item, data
+
+  def remove_spooled(self, spool_id):
+    for path in self.spool_paths(spool_id):
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+  def retry_spooled(self):
+    while self.keep_uploading:
+      with self.spool_lock:
+        if len(self.spool_due) == 0:
+          self.spool_lock.wait(1)
+          continue
+
+        due_time, spool_id = self.spool_due[0]
+        delay = due_time - time.time()
+        if delay > 0:
+          self.spool_lock.wait(min(delay, 1))
+          continue
+
+        heapq.heappop(self.spool_due)
+
+      try:
+        item, data = self.read_spooled(spool_id)
+      except Exception as e:
+        logging.warning(f"Could not read spooled image {spool_id}: {e}")
+        self.remove_spooled(spool_id)
+        continue
+
+      uploaded = self.try_upload(item, data)
+      self.remove_spooled(spool_id)
+
+      if not uploaded:
+        self.spool(item, data)
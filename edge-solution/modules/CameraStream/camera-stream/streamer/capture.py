@@ -0,0 +1,187 @@
+import logging, re
+import subprocess
+import shutil
+import cv2
+import numpy as np
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+# ***********************************************************************************
+# Capture backends
+#
+# Every backend looks like a cv2.VideoCapture as far as VideoStream is concerned:
+# read(), grab(), get(prop), isOpened() and release().
+#
+# Options, set per camera under "capture" in the twin:
+#   backend: "opencv" (default), "ffmpeg" or "gstreamer"
+#   transport: "tcp" or "udp" for RTSP, TCP avoids smeared frames on lossy links
+#   low_latency: don't buffer, hand frames over as soon as they are decoded
+#   width, height: size frames come out of the decoder. Setting them to the inference size
+#     saves converting and resizing full frames, but the images we upload get that small too
+#   fps: frames per second decoded into images, the rest are dropped inside the pipeline
+#   keyframes_only: (ffmpeg) only decode key frames, by far the cheapest for long intervals
+#   hwaccel: (ffmpeg) hardware decoder, e.g. "cuda", "vaapi"
+#   pipeline: (gstreamer) full pipeline ending in appsink, replaces the generated one
+#
+def open_capture(source, options=None):
+  '''
+  Returns a capture for the source with the backend picked in options
+  '''
+  options = options if options is not None else dict()
+  backend = options.get("backend", "opencv")
+
+  if backend == "opencv":
+    return cv2.VideoCapture(source)
+  if backend == "ffmpeg":
+    return FFmpegCapture(source, options)
+  if backend == "gstreamer":
+    return open_gstreamer_capture(source, options)
+
+  raise ValueError(f"Unknown capture backend: {backend}")
+
+def is_rtsp(source):
+  return isinstance(source, str) and source.lower().startswith("rtsp")
+
+class FFmpegCapture:
+  '''
+  Decodes with an ffmpeg process that writes raw BGR frames to a pipe.
+  Scaling and frame rate reduction happen in ffmpeg before frames ever reach python
+  '''
+
+  def __init__(self, source, options):
+    if shutil.which("ffmpeg") is None:
+      raise RuntimeError("ffmpeg backend needs the ffmpeg binary")
+
+    self.source = source
+    self.options = options
+    self.process = None
+
+    self.width, self.height, self.fps = self.probe()
+    if "width" in options and "height" in options:
+      self.width, self.height = int(options["width"]), int(options["height"])
+    if "fps" in options:
+      self.fps = float(options["fps"])
+
+    self.frame_size = self.width * self.height * 3
+    self.process = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    bufsize=self.frame_size)
+    logging.info(f"ffmpeg decoding {source} at {self.width}x{self.height}")
+
+  def input_args(self):
+    args = ["-hide_banner", "-loglevel", "error"]
+
+    if is_rtsp(self.source):
+      args += ["-rtsp_transport", self.options.get("transport", "tcp")]
+    if self.options.get("low_latency", False):
+      args += ["-fflags", "nobuffer", "-flags", "low_delay"]
+    if self.options.get("keyframes_only", False):
+      args += ["-skip_frame", "nokey"]
+    if "hwaccel" in self.options:
+      args += ["-hwaccel", self.options["hwaccel"]]
+
+    return args
+
+  def probe(self):
+    '''
+    Size and frame rate of the source as ffprobe sees them
+    '''
+    probe = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                            "-show_entries", "stream=width,height,avg_frame_rate", "-of", "csv=p=0"]
+                           + (["-rtsp_transport", self.options.get("transport", "tcp")] if is_rtsp(self.source) else [])
+                           + [self.source], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True, timeout=30)
+
+    fields = probe.stdout.strip().split(",")
+    if probe.returncode != 0 or len(fields) < 3:
+      raise RuntimeError(f"Could not probe {self.source}: {probe.stderr.strip()}")
+
+    num, _, den = fields[2].partition("/")
+    fps = float(num) / float(den) if den not in ["", "0"] else float(num or 0)
+    return int(fields[0]), int(fields[1]), fps
+
+  def command(self):
+    filters = []
+    if "fps" in self.options:
+      filters.append(f"fps={self.fps}")
+    filters.append(f"scale={self.width}:{self.height}")
+
+    return ["ffmpeg"] + self.input_args() + ["-i", self.source, "-an", "-vf", ",".join(filters),
+                                             "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+
+  def read_buffer(self):
+    buffer = self.process.stdout.read(self.frame_size)
+    if buffer is None or len(buffer) < self.frame_size:
+      return None
+    return buffer
+
+  def read(self):
+    buffer = self.read_buffer()
+    if buffer is None:
+      return False, None
+
+    # bytearray backed, so the frame is writable like the ones cv2 hands out
+    return True, np.frombuffer(bytearray(buffer), dtype=np.uint8).reshape(self.height, self.width, 3)
+
+  def grab(self):
+    return self.read_buffer() is not None
+
+  def get(self, prop):
+    if prop == cv2.CAP_PROP_FPS:
+      return self.fps
+    if prop == cv2.CAP_PROP_FRAME_WIDTH:
+      return self.width
+    if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+      return self.height
+    return 0
+
+  def isOpened(self):
+    return self.process is not None and self.process.poll() is None
+
+  def release(self):
+    if self.process is None:
+      return
+
+    self.process.kill()
+    self.process.wait()
+    self.process.stdout.close()
+    self.process = None
+
+def gstreamer_pipeline(source, options):
+  '''
+  Decode -> (rate) -> scale -> BGR -> appsink. decodebin picks a hardware decoder when the box has one
+  '''
+  if "pipeline" in options:
+    return options["pipeline"]
+
+  if is_rtsp(source):
+    protocols = "tcp" if options.get("transport", "tcp") == "tcp" else "udp"
+    latency = 0 if options.get("low_latency", False) else 200
+    elements = [f"rtspsrc location={source} protocols={protocols} latency={latency}", "decodebin"]
+  else:
+    elements = [f"filesrc location={source}", "decodebin"]
+
+  if "fps" in options:
+    elements += ["videorate drop-only=true", f"video/x-raw,framerate={int(round(float(options['fps']) * 1000))}/1000"]
+
+  # scale while still in YUV, less to convert afterwards
+  if "width" in options and "height" in options:
+    elements += ["videoscale", f"video/x-raw,width={int(options['width'])},height={int(options['height'])}"]
+
+  elements += ["videoconvert", "video/x-raw,format=BGR"]
+
+  sink = "appsink sync=false"
+  if options.get("low_latency", False):
+    sink += " drop=true max-buffers=1"
+  elements.append(sink)
+
+  return " ! ".join(elements)
+
+def open_gstreamer_capture(source, options):
+  if re.search(r"GStreamer:\s*YES", cv2.getBuildInformation()) is None:
+    raise RuntimeError("gstreamer backend needs OpenCV built with GStreamer")
+
+  pipeline = gstreamer_pipeline(source, options)
+  logging.info(f"GStreamer pipeline: {pipeline}")
+
+  return cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
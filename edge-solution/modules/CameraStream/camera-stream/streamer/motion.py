@@ -0,0 +1,72 @@
+import logging
+import cv2
+import imutils
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+class MotionGate:
+  '''
+  Cheap scene change detector that decides whether a frame is worth sending to the detector.
+
+  Frames are compared, downscaled, grayscale and blurred, against the frame we last ran inference on,
+  so slow changes add up until they trigger. A static scene is still refreshed every refresh_interval.
+  '''
+
+  def __init__(self, threshold=25, min_area=0.005, refresh_interval=30., width=160):
+    '''
+    Parameters:
+      threshold: gray level difference (0-255) for a pixel to count as changed
+      min_area: fraction of the frame that has to change to call it motion
+      refresh_interval: longest time without inference (sec)
+      width: width frames are downscaled to before comparing
+    '''
+    self.threshold = threshold
+    self.min_area = min_area
+    self.refresh_interval = refresh_interval
+    self.width = width
+
+    self.reference = None
+    self.last_inference_time = None
+    self.last_detections = []
+
+    self.skipped = 0
+
+  def prepare(self, frame):
+    small = imutils.resize(frame, width=self.width)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(gray, (5, 5), 0)
+
+  def changed_area(self, prepared):
+    '''
+    Fraction of the frame that differs from the reference
+    '''
+    delta = cv2.absdiff(self.reference, prepared)
+    _, mask = cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)
+    return cv2.countNonZero(mask) / mask.size
+
+  def should_infer(self, frame, now):
+    '''
+    True if the scene changed or is due for a refresh, the frame then becomes the new reference
+    '''
+    prepared = self.prepare(frame)
+
+    if self.reference is None or self.reference.shape != prepared.shape \
+      or now - self.last_inference_time >= self.refresh_interval \
+      or self.changed_area(prepared) >= self.min_area:
+
+      self.reference = prepared
+      self.last_inference_time = now
+      return True
+
+    self.skipped += 1
+    return False
+
+  def update(self, detections):
+    self.last_detections = detections
+
+  def reset(self):
+    '''
+    Inference on the reference frame did not go through, run it on the next frame
+    '''
+    self.reference = None
@@ -0,0 +1,249 @@
+import os, logging, re
+import multiprocessing
+from queue import Empty
+import numpy as np
+from streamer.shared_memory import SharedMemoryManager, SharedMemoryRing
+from streamer.videostream import VideoStream
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+# stats the capture process shares with us
+CAPTURED, SKIPPED, DROPPED = range(3)
+
+def create_ring(shm_name, slots, frame_size):
+  '''
+  Shared memory ring of slots frames of frame_size bytes. An existing ring is unlinked first,
+  the reader keeps its mapping of the old one until it notices the new generation
+  '''
+  try:
+    os.remove(os.path.join('/dev/shm', shm_name))
+  except FileNotFoundError:
+    pass
+
+  slot_size = (frame_size + 63) & ~63
+  shm_size = SharedMemoryRing._headerSize + slots * (SharedMemoryRing._slotSize + slot_size)
+
+  shared_memory = SharedMemoryManager(shm_name, shm_size, create=True)
+  return shared_memory, shared_memory.GetRing(slots)
+
+def run_capture(shm_name, slots, stream_source, interval, capture_options, stop_capture, stats, generation):
+  '''
+  Capture process: runs a VideoStream and writes every frame it serves into the shared memory ring.
+  Frame ids in the ring count up across reconnects so the reader can tell which frame is newest.
+  interval is shared with the parent, changes are picked up without reconnecting.
+  The ring is only made once we know how big the frames are, and made again if they grow,
+  generation tells the parent to map it again
+  '''
+  shared_memory, ring = None, None
+  video = VideoStream(stream_source, interval.value, latest_only=True, capture_options=capture_options)
+  video.start()
+
+  frame_count = 0
+  while not stop_capture.is_set():
+    if interval.value != video.interval:
+      video.set_interval(interval.value)
+
+    try:
+      _, frame, capture_time = video.frame_queue.get(timeout=0.5)
+    except Empty:
+      continue
+
+    frame_count += 1
+    try:
+      if ring is None or frame.nbytes > ring.slotSize:
+        shared_memory, ring = create_ring(shm_name, slots, frame.nbytes)
+        generation.value += 1
+
+      ring.WriteFrame(frame, frame_count, capture_time)
+    except (OSError, ValueError) as e:
+      logging.error(f"Could not hand over frame from {stream_source}: {e}")
+      # made again with the next frame, create_ring replaces the file
+      ring = None
+
+    stats[CAPTURED] = video.frames_captured
+    stats[SKIPPED] = video.frames_skipped
+    stats[DROPPED] = video.frames_dropped
+
+  video.stop()
+
+class ProcessVideoStream:
+  '''
+  VideoStream running in a process of its own, so that decoding and the capture loop of
+  every camera get their own core instead of sharing the GIL with the pipelines.
+  Frames come back through a small shared memory ring, we only read the slot descriptors
+  and copy out the newest frame when it is asked for
+  '''
+  # spawn, not fork: we are full of threads (IoT client, uploads, other cameras)
+  mp_context = multiprocessing.get_context("spawn")
+
+  def __init__(self, name, stream_source, interval=0.5, capture_options=None, slots=3):
+    '''
+    Parameters:
+      name: camera name, makes the shared memory file unique
+      stream_source, interval, capture_options: see VideoStream
+      slots: frames in the ring, the capture process never waits on us.
+        The ring takes slots times the frame size of /dev/shm
+    '''
+    self.cam = stream_source
+    self.interval = interval
+    self.capture_options = capture_options
+    self.shm_name = "camera-" + re.sub(r"[^A-Za-z0-9_.-]", "-", name)
+    self.slots = slots
+
+    self.shared_memory = None
+    self.ring = None
+    # generation of the ring we have mapped, the capture process counts up in shared_generation
+    self.ring_generation = 0
+    self.shared_generation = self.mp_context.Value('q', 0, lock=False)
+
+    self.stats = self.mp_context.Array('q', 3, lock=False)
+    self.shared_interval = self.mp_context.Value('d', interval, lock=False)
+    self.stop_capture = self.mp_context.Event()
+    self.capture_process = None
+
+    self.last_frame_id = 0
+    self.frames_missed = 0
+
+  def start(self):
+    if self.capture_process is not None:
+      self.stop()
+
+    # the new process makes a fresh ring, frame ids start over
+    self.shared_memory = None
+    self.ring = None
+    self.ring_generation = 0
+    self.shared_generation.value = 0
+    self.last_frame_id = 0
+
+    self.stop_capture.clear()
+    self.capture_process = self.mp_context.Process(target=run_capture,
+                                                   args=(self.shm_name, self.slots, self.cam, self.shared_interval,
+                                                         self.capture_options, self.stop_capture, self.stats,
+                                                         self.shared_generation))
+    self.capture_process.daemon = True
+    self.capture_process.start()
+    logging.info(f"Started capture process {self.capture_process.pid} for {self.cam}")
+
+  def stop(self):
+    '''
+    Stops capturing and removes the shared memory file
+    '''
+    if self.capture_process is None:
+      return
+
+    self.stop_capture.set()
+    self.capture_process.join(2)
+    if self.capture_process.is_alive():
+      self.capture_process.terminate()
+      self.capture_process.join()
+
+    self.capture_process = None
+    self.ring = None
+    self.shared_memory = None
+    try:
+      os.remove(os.path.join('/dev/shm', self.shm_name))
+    except FileNotFoundError:
+      pass
+
+    logging.info(f"Stopped capture process for {self.cam}")
+
+  def reset(self, stream_source, interval):
+    '''
+    A new source takes a new capture process
+    '''
+    if stream_source == "":
+      raise ValueError("stream cannot be empty")
+
+    self.stop()
+    self.cam = stream_source
+    self.set_interval(interval)
+    self.start()
+
+  def set_interval(self, interval):
+    if interval <= 0 or interval >= 24 * 3600:
+      raise ValueError("pulse interval should be positive, shorter than a day")
+
+    self.interval = interval
+    self.shared_interval.value = interval
+
+  @property
+  def frames_captured(self):
+    return self.stats[CAPTURED]
+
+  @property
+  def frames_skipped(self):
+    return self.stats[SKIPPED]
+
+  @property
+  def frames_dropped(self):
+    '''
+    Frames replaced before anyone read them, in the capture process or in the ring
+    '''
+    return self.stats[DROPPED] + self.frames_missed
+
+  def queue_depth(self):
+    return 1 if self.newest_slot()[2] > self.last_frame_id else 0
+
+  def open_ring(self):
+    '''
+    Maps the ring the capture process made last, None until it made one
+    '''
+    generation = self.shared_generation.value
+    if generation == self.ring_generation:
+      return self.ring
+
+    try:
+      shm_size = os.path.getsize(os.path.join('/dev/shm', self.shm_name))
+      self.shared_memory = SharedMemoryManager(self.shm_name, shm_size)
+    except (OSError, ValueError):
+      return self.ring
+
+    self.ring = self.shared_memory.GetRing()
+    self.ring_generation = generation
+    return self.ring
+
+  def newest_slot(self):
+    '''
+    Returns (slot, sequence, frame id, timestamp) of the newest complete frame in the ring
+    '''
+    newest = (None, None, 0, None)
+    if self.open_ring() is None:
+      return newest
+
+    for slot in range(self.ring.slotCount):
+      descriptor = self.ring.ReadDescriptor(slot)
+      if descriptor["seq"] == 0 or descriptor["seq"] % 2 != 0:
+        continue
+      if descriptor["frameId"] > newest[2]:
+        newest = (slot, descriptor["seq"], descriptor["frameId"], descriptor["timestamp"])
+
+    return newest
+
+  def get_frame_with_id(self):
+    frame_id, frame, _ = self.get_frame_with_timestamp()
+    return frame_id, frame
+
+  def get_frame_with_timestamp(self):
+    '''
+    Copies out the newest frame we have not served yet
+    '''
+    for _ in range(3):
+      slot, seq, frame_id, timestamp = self.newest_slot()
+      if slot is None or frame_id <= self.last_frame_id:
+        break
+
+      frame = self.ring.ReadFrame(slot, seq)
+      if frame is None:
+        continue
+      frame = np.array(frame)
+
+      # the capture process lapped us while we were copying, try the next newest
+      if not self.ring.IsCurrent(slot, seq):
+        continue
+
+      self.frames_missed += max(0, frame_id - self.last_frame_id - 1)
+      self.last_frame_id = frame_id
+      return frame_id, frame, timestamp
+
+    return -1, None, None
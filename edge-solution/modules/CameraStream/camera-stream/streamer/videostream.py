@@ -2,18 +2,71 @@ import os, logging, time
 import cv2
 from queue import Queue, Full, Empty
 import threading
+from streamer.capture import open_capture
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
 
+class FrameMailbox:
+  '''
+  Single slot frame buffer: a new frame replaces the one nobody picked up yet.
+  Exposes the bits of the Queue interface VideoStream uses
+  '''
+
+  def __init__(self):
+    self.frame_ready = threading.Condition()
+    self.entry = None
+    self.dropped = 0
+
+  def put(self, entry, timeout=None):
+    '''
+    Never blocks, timeout is there to match Queue.put
+    '''
+    with self.frame_ready:
+      if self.entry is not None:
+        self.dropped += 1
+      self.entry = entry
+      self.frame_ready.notify()
+
+  def get(self, timeout=None):
+    with self.frame_ready:
+      if not self.frame_ready.wait_for(lambda: self.entry is not None, timeout):
+        raise Empty
+      entry, self.entry = self.entry, None
+    return entry
+
+  def get_nowait(self):
+    with self.frame_ready:
+      if self.entry is None:
+        raise Empty
+      entry, self.entry = self.entry, None
+    return entry
+
+  def qsize(self):
+    return 0 if self.entry is None else 1
+
+def enqueue_frame(frame_queue, entry, stop_grabbing):
+  '''
+  A full queue blocks the grabber only until it is stopped
+  '''
+  while not stop_grabbing.is_set():
+    try:
+      frame_queue.put(entry, timeout=0.5)
+      return
+    except Full:
+      continue
+
 class VideoStream:
   default_fps = 30.
 
-  def __init__(self, stream_source, interval=0.5):
+  def __init__(self, stream_source, interval=0.5, latest_only=None, capture_options=None):
     '''
     Parameters:
       stream_source: RTSP, camera index, or video file name
       self.interval: how long to wait before next frame is served (sec)
+      latest_only: only keep the latest frame instead of queueing them.
+        Defaults to True for live RTSP sources
+      capture_options: capture backend and its options, see streamer/capture.py
     '''
 
     if stream_source == "":
@@ -21,32 +74,53 @@ class VideoStream:
     if interval <= 0 or interval >= 24 * 3600:
       raise ValueError("pulse interval should be positive, shorter than a day")
 
-    self.keep_listeing_for_frames = True
-    self.frame_queue = Queue(100)
     self.cam = stream_source
     self.interval = interval 
+    self.capture_options = capture_options
+    # every grabber thread has its own stop event and capture, a thread still
+    # blocked in a read when we move on never touches the next one's
     self.frame_grabber = None
+    self.stop_grabbing = None
     self.is_rtsp = self.cam.lower().startswith('rtsp')
 
+    self.latest_only = self.is_rtsp if latest_only is None else latest_only
+    self.frame_queue = self.create_frame_queue()
+    self.frames_captured = 0
+    # frames grabbed but never decoded into an image
+    self.frames_skipped = 0
+    self.last_kept_time = 0
+
     self.fps = None
     self.delay_frames = None
     self.delay_time = None
-    self.video_capture = None
+
+  def create_frame_queue(self):
+    frame_queue = FrameMailbox() if self.latest_only else Queue(100)
+
+    # keep counting the frames the mailboxes before dropped
+    if self.latest_only and getattr(self, "frame_queue", None) is not None:
+      frame_queue.dropped = self.frame_queue.dropped
+
+    return frame_queue
 
   def stop(self):
     
-    self.keep_listeing_for_frames = False
     if self.frame_grabber is None:
       return
 
+    self.stop_grabbing.set()
     try:
+      self.frame_grabber.join(1)
       if self.frame_grabber.is_alive():
-        self.frame_grabber.join(1)
-      self.frame_grabber = None
-      logging.info("Stopped grabbing frames")
+        logging.warning(f"Frame grabber for {self.cam} is still blocked, it exits once its read returns")
+      else:
+        logging.info("Stopped grabbing frames")
     except:
       logging.critical("Error while stopping thread")
 
+    self.frame_grabber = None
+    self.stop_grabbing = None
+
   def reset(self, stream_source, interval):
     '''
     Any change to stream source or interval will re-set streaming
@@ -58,49 +132,124 @@ class VideoStream:
       raise ValueError("pulse interval should be positive, shorter than a day")
 
     self.stop()
+    # a grabber still blocked on the old source fills the old queue, if anything
+    self.frame_queue = self.create_frame_queue()
 
     self.cam = stream_source
     self.interval = interval 
+    self.is_rtsp = self.cam.lower().startswith('rtsp')
 
     self.start()
 
+  def set_interval(self, interval):
+    '''
+    Changes the pace frames are served at without reconnecting
+    '''
+    if interval <= 0 or interval >= 24 * 3600:
+      raise ValueError("pulse interval should be positive, shorter than a day")
+
+    self.interval = interval
+    if self.delay_frames is not None:
+      self.delay_frames = max(1, int(round(self.interval * self.fps)))
+    elif self.delay_time is not None:
+      self.delay_time = self.interval
+    logging.info(f"Serving {self.cam} every {self.interval} sec")
+
   def start(self):
     if self.frame_grabber is not None:
       self.stop()
 
-    self.keep_listeing_for_frames = True
-    self.frame_grabber = threading.Thread(target=self.stream_video)
+    self.stop_grabbing = threading.Event()
+    self.frame_grabber = threading.Thread(target=self.stream_video, args=(self.stop_grabbing, self.frame_queue))
     self.frame_grabber.daemon = True
     self.frame_grabber.start()
     logging.info(f"Started listening for {self.cam}")
 
+  @property
+  def frames_dropped(self):
+    '''
+    Frames replaced in the mailbox before anyone read them
+    '''
+    return self.frame_queue.dropped if self.latest_only else 0
+
+  def queue_depth(self):
+    return self.frame_queue.qsize()
+
   def get_frame_with_id(self):
     '''
     Retrieves the frame together with its frame id
     '''
+    frame_id, frame, _ = self.get_frame_with_timestamp()
+    return frame_id, frame
+
+  def get_frame_with_timestamp(self):
+    '''
+    Retrieves the frame together with its frame id and capture time
+    '''
     try:
-      frame_and_id = self.frame_queue.get_nowait()
+      frame_entry = self.frame_queue.get_nowait()
     except Empty:
-      frame_and_id = (-1, None)
+      frame_entry = (-1, None, None)
     
-    return frame_and_id
+    return frame_entry
+
+  def open_capture(self):
+    try:
+      return open_capture(self.cam, self.capture_options)
+    except Exception as e:
+      logging.error(f"Could not open {self.cam} with {self.capture_options}: {e}, falling back to OpenCV")
+      return cv2.VideoCapture(self.cam)
+
+  def setup_stream(self, stop_grabbing):
+    '''
+    Opens a capture for the calling grabber thread and determines streaming speed
+    '''
+    video_capture = self.open_capture()
 
-  def setup_stream(self):
+    # stopped while connecting, leave the pacing to the grabber that replaced us
+    if stop_grabbing.is_set():
+      return video_capture
 
-    self.video_capture = cv2.VideoCapture(self.cam)
+    self.delay_frames = None
+    self.delay_time = None
+    self.last_kept_time = 0
 
     # retrieve camera properties. 
-    # self.fps may not always be available
-    # TODO: Need to support frame counting for RTSP!
-    self.fps = self.video_capture.get(cv2.CAP_PROP_FPS)
+    # self.fps may not always be available and RTSP sources
+    # often report a bogus one, so we pace those by time instead
+    self.fps = video_capture.get(cv2.CAP_PROP_FPS)
     
-    if self.fps is not None and self.fps > 0:
-      self.delay_frames = int(round(self.interval * self.fps))
+    if self.fps is not None and self.fps > 0 and not self.is_rtsp:
+      self.delay_frames = max(1, int(round(self.interval * self.fps)))
       logging.info(f"Retrieved FPS: {self.fps}")
     else:
       self.delay_time = self.interval
 
-  def stream_video(self):
+    return video_capture
+
+  def should_keep_frame(self, frame_number, now):
+    '''
+    Decides whether the next frame is served, or only grabbed to advance the stream
+    '''
+    if self.delay_frames is not None:
+      return (frame_number - 1) % self.delay_frames == 0
+
+    if self.is_rtsp:
+      return now - self.last_kept_time >= self.delay_time
+
+    return True
+
+  def read_frame(self, video_capture, keep):
+    '''
+    Only frames we keep are retrieved (converted to BGR and copied out),
+    the rest are just grabbed
+    '''
+    if keep:
+      return video_capture.read()
+
+    return video_capture.grab(), None
+
+  def stream_video(self, stop_grabbing, frame_queue):
 
     repeat = 3
     wait = 0.1
@@ -111,27 +260,33 @@ class VideoStream:
     continuous_frame = 0
 
     # will create a new video capture and determine streaming speed
-    self.setup_stream()
+    video_capture = self.setup_stream(stop_grabbing)
 
-    while self.keep_listeing_for_frames:
+    while not stop_grabbing.is_set():
       start_time = time.time()
+      res, frame = False, None
+      keep = self.should_keep_frame(continuous_frame + 1, start_time)
 
       for _ in range(repeat):
         try:
-            res, frame = self.video_capture.read()
+            res, frame = self.read_frame(video_capture, keep)
 
             if not res:
-              self.video_capture = cv2.VideoCapture(self.cam)
-              res, frame = self.video_capture.read()
+              video_capture.release()
+              if stop_grabbing.is_set():
+                break
+              video_capture = self.open_capture()
               cur_frame = 0
               continuous_frame = 0
+              keep = self.should_keep_frame(continuous_frame + 1, start_time)
+              res, frame = self.read_frame(video_capture, keep)
             break
         except:
             # try to re-capture the stream
             logging.info("Could not capture video. Recapturing and retrying...")
             time.sleep(wait)
 
-      if frame is None:
+      if not res or (keep and frame is None):
         logging.info("Failed to capture frame, sending blank image")
         continue
 
@@ -147,11 +302,17 @@ class VideoStream:
       cur_frame += 1
 
       continuous_frame += 1
-      if self.delay_frames is not None and (continuous_frame - 1) % self.delay_frames != 0:
+      if not keep:
+        self.frames_skipped += 1
         continue
 
-      self.frame_queue.put((cur_frame, frame))
+      # we were stopped while blocked in the read, the frame is from the old source
+      if stop_grabbing.is_set():
+        break
+
+      self.last_kept_time = start_time
+      self.frames_captured += 1
+      enqueue_frame(frame_queue, (cur_frame, frame, time.time()), stop_grabbing)
 
-    self.video_capture.release()
-    self.video_capture = None
+    video_capture.release()
 
@@ -0,0 +1,210 @@
+import logging
+import numpy as np
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+def iou_matrix(boxes_a, boxes_b):
+  '''
+  Pairwise IoU of (N, 4) and (M, 4) boxes in (startX, startY, endX, endY) format
+  '''
+  x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+  y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+  x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+  y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+  inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+  areas_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+  areas_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+  return inter / (areas_a[:, None] + areas_b[None, :] - inter + 1e-9)
+
+class Track:
+  '''
+  One object followed across frames with a constant velocity Kalman filter
+  over its box center and size: [cx, cy, w, h, vx, vy, vw, vh]
+  '''
+  # boxes are normalized (0-1) like the detections. Measurement noise is the standard
+  # deviation of a detected box coordinate, about 1% of the frame
+  measurement_noise = 0.01
+  # variance the box (position, size) and its velocity pick up per second
+  position_noise = 1e-5
+  velocity_noise = 1e-3
+
+  def __init__(self, track_id, detection, now):
+    self.track_id = track_id
+    self.detection = detection
+    self.last_time = now
+
+    self.hits = 1
+    self.misses = 0
+    self.confirmed = False
+
+    self.x = np.zeros(8)
+    self.x[:4] = self.to_measurement(detection["bbox"])
+    # the box is as certain as a measurement, the velocity unknown up to a frame per 10 sec
+    self.P = np.diag([self.measurement_noise ** 2] * 4 + [1e-2] * 4)
+
+  @staticmethod
+  def to_measurement(bbox):
+    startX, startY, endX, endY = bbox
+    return np.array([(startX + endX) / 2, (startY + endY) / 2, endX - startX, endY - startY])
+
+  def bbox(self):
+    cx, cy, w, h = self.x[:4]
+    w, h = max(w, 0.), max(h, 0.)
+    return [cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2]
+
+  def predict(self, now):
+    dt = max(now - self.last_time, 0.)
+    self.last_time = now
+
+    F = np.eye(8)
+    F[:4, 4:] = np.eye(4) * dt
+    Q = np.diag([self.position_noise] * 4 + [self.velocity_noise] * 4) * max(dt, 1e-3)
+
+    self.x = F @ self.x
+    self.P = F @ self.P @ F.T + Q
+    return self.bbox()
+
+  def correct(self, detection):
+    H = np.eye(4, 8)
+    R = np.eye(4) * self.measurement_noise ** 2
+
+    y = self.to_measurement(detection["bbox"]) - H @ self.x
+    S = H @ self.P @ H.T + R
+    K = self.P @ H.T @ np.linalg.inv(S)
+
+    self.x = self.x + K @ y
+    self.P = (np.eye(8) - K @ H) @ self.P
+
+    self.detection = detection
+    self.hits += 1
+    self.misses = 0
+
+class ObjectTracker:
+  '''
+  SORT style tracker for the detections of one camera.
+
+  update() runs on frames that went through the detector: tracks are predicted to the frame time
+  and matched to the detections by IoU. predict() runs on the frames in between and moves the
+  tracks along their velocity. A track is announced ("enter") once it has been matched min_hits
+  times and dropped ("exit") after max_age detection rounds without a match.
+  '''
+
+  def __init__(self, iou_threshold=0.3, max_age=3, min_hits=2, detect_every=1):
+    '''
+    Parameters:
+      iou_threshold: least overlap between a predicted track and a detection to match them
+      max_age: detection rounds a track survives without being matched
+      min_hits: matches before a track is reported
+      detect_every: run the detector on every Nth frame, track in between
+    '''
+    self.iou_threshold = iou_threshold
+    self.max_age = max_age
+    self.min_hits = min_hits
+    self.detect_every = max(1, detect_every)
+
+    self.tracks = []
+    self.next_id = 1
+    self.frame_count = 0
+
+  def needs_detection(self):
+    '''
+    Called once per frame, True if the frame should go through the detector
+    '''
+    due = self.frame_count % self.detect_every == 0
+    self.frame_count += 1
+    return due
+
+  def tracked_detection(self, track, bbox=None):
+    detection = dict(track.detection)
+    detection["track_id"] = track.track_id
+    if bbox is not None:
+      detection["bbox"] = [float(v) for v in bbox]
+    return detection
+
+  def event(self, name, track, now):
+    return {"event": name, "track_id": track.track_id, "label": track.detection.get("label"),
+            "bbox": track.detection["bbox"], "time": now}
+
+  def match(self, predicted, detections):
+    '''
+    Greedy matching, best overlap first, objects only match tracks of the same class.
+    Returns (track index, detection index) pairs
+    '''
+    if len(predicted) == 0 or len(detections) == 0:
+      return []
+
+    iou = iou_matrix(np.array(predicted, dtype=np.float32),
+                     np.array([detection["bbox"] for detection in detections], dtype=np.float32))
+
+    track_classes = np.array([track.detection.get("class") for track in self.tracks])
+    detection_classes = np.array([detection.get("class") for detection in detections])
+    iou[track_classes[:, None] != detection_classes[None, :]] = 0
+
+    matches = []
+    while True:
+      t, d = np.unravel_index(np.argmax(iou), iou.shape)
+      if iou[t, d] < self.iou_threshold:
+        break
+
+      matches.append((t, d))
+      iou[t, :] = 0
+      iou[:, d] = 0
+
+    return matches
+
+  def update(self, detections, now):
+    '''
+    Parameters:
+      detections: detector output for the frame, dicts with "bbox", "label" and "class"
+      now: capture time of the frame (sec)
+    Returns the detections of confirmed tracks with their "track_id", and the enter/exit events
+    '''
+    predicted = [track.predict(now) for track in self.tracks]
+    matches = self.match(predicted, detections)
+
+    events = []
+    matched_tracks = set()
+    matched_detections = set()
+
+    for t, d in matches:
+      track = self.tracks[t]
+      track.correct(detections[d])
+      matched_tracks.add(t)
+      matched_detections.add(d)
+
+      if not track.confirmed and track.hits >= self.min_hits:
+        track.confirmed = True
+        events.append(self.event("enter", track, now))
+
+    for t, track in enumerate(self.tracks):
+      if t not in matched_tracks:
+        track.misses += 1
+
+    for d, detection in enumerate(detections):
+      if d not in matched_detections:
+        track = Track(self.next_id, detection, now)
+        self.next_id += 1
+        self.tracks.append(track)
+
+        if self.min_hits <= 1:
+          track.confirmed = True
+          events.append(self.event("enter", track, now))
+
+    alive = []
+    for track in self.tracks:
+      if track.misses <= self.max_age:
+        alive.append(track)
+      elif track.confirmed:
+        events.append(self.event("exit", track, now))
+    self.tracks = alive
+
+    tracked = [self.tracked_detection(track) for track in self.tracks if track.confirmed and track.misses == 0]
+    return tracked, events
+
+  def predict(self, now):
+    '''
+    Where the confirmed tracks are expected to be at time now, for frames we do not run the detector on
+    '''
+    return [self.tracked_detection(track, track.predict(now)) for track in self.tracks if track.confirmed]
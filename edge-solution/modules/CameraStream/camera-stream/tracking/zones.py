@@ -0,0 +1,115 @@
+import logging
+import numpy as np
+
+logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
+                    level=logging.INFO)
+
+def points_in_polygon(points, polygon):
+  '''
+  Ray casting for (P, 2) points against an (E, 2) polygon, all points at once.
+  Returns a (P,) boolean array
+  '''
+  xi, yi = polygon[:, 0], polygon[:, 1]
+  xj, yj = np.roll(xi, 1), np.roll(yi, 1)
+  px, py = points[:, 0:1], points[:, 1:2]
+
+  crosses = (yi > py) != (yj > py)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    x_cross = (xj - xi) * (py - yi) / (yj - yi) + xi
+
+  return np.count_nonzero(crosses & (px < x_cross), axis=1) % 2 == 1
+
+def edges_cross_boxes(boxes, polygon):
+  '''
+  Liang-Barsky clipping of every polygon edge against every (N, 4) box.
+  Returns (N,) True where some edge passes through the box
+  '''
+  x0, y0 = polygon[:, 0], polygon[:, 1]
+  dx, dy = np.roll(x0, -1) - x0, np.roll(y0, -1) - y0
+
+  # boundaries: left, right, top, bottom -> (N, 4, E)
+  p = np.stack([-dx, dx, -dy, dy])[None, :, :].repeat(len(boxes), axis=0)
+  q = np.stack([x0[None, :] - boxes[:, 0:1], boxes[:, 2:3] - x0[None, :],
+                y0[None, :] - boxes[:, 1:2], boxes[:, 3:4] - y0[None, :]], axis=1)
+
+  with np.errstate(divide="ignore", invalid="ignore"):
+    t = q / p
+
+  parallel = p == 0
+  t_enter = np.max(np.where(p < 0, t, 0.), axis=1)
+  t_exit = np.min(np.where(p > 0, t, 1.), axis=1)
+  outside = np.any(parallel & (q < 0), axis=1)
+
+  return np.any((t_enter <= t_exit) & ~outside, axis=1)
+
+class ZoneOccupancy:
+  '''
+  Counts the detections of a camera that fall into polygon zones, the edge side version of
+  the dashboard's Collision.js. Boxes and polygons use the same normalized (0-1) coordinates.
+
+  mode "overlap" counts a detection if its box touches the zone (what the dashboard does),
+  "foot" only if the bottom center of the box is inside, which suits people on a floor plan
+  '''
+
+  def __init__(self, zones, mode="overlap"):
+    '''
+    Parameters:
+      zones: list of {"name": ..., "polygon": [[x, y], ...]}, polygons with less than 3 points are ignored
+      mode: "overlap" or "foot"
+    '''
+    if mode not in ["overlap", "foot"]:
+      raise ValueError(f"Unknown zone mode: {mode}")
+
+    self.mode = mode
+    self.zones = [(zone.get("name", str(i)), np.array(zone["polygon"], dtype=np.float32))
+                  for i, zone in enumerate(zones) if len(zone.get("polygon", [])) >= 3]
+
+    # zone name -> whether anyone was in it on the last frame
+    self.occupied = {name: False for name, _ in self.zones}
+
+  def membership(self, detections):
+    '''
+    Returns an (N detections, Z zones) boolean array
+    '''
+    inside = np.zeros((len(detections), len(self.zones)), dtype=bool)
+    if len(detections) == 0:
+      return inside
+
+    boxes = np.array([detection["bbox"] for detection in detections], dtype=np.float32)
+
+    if self.mode == "foot":
+      feet = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, boxes[:, 3]], axis=1)
+      for z, (_, polygon) in enumerate(self.zones):
+        inside[:, z] = points_in_polygon(feet, polygon)
+      return inside
+
+    corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 2)
+    for z, (_, polygon) in enumerate(self.zones):
+      # box inside the zone, or some zone edge passing through the box
+      corners_inside = points_in_polygon(corners, polygon).reshape(-1, 4)
+      inside[:, z] = np.any(corners_inside, axis=1) | edges_cross_boxes(boxes, polygon)
+
+    return inside
+
+  def update(self, detections, now):
+    '''
+    Marks each detection with "collides" and counts them per zone.
+    Returns the counts, the number of detections in any zone and the occupied/vacant events
+    '''
+    inside = self.membership(detections)
+    in_any = np.any(inside, axis=1)
+
+    for detection, collides in zip(detections, in_any.tolist()):
+      detection["collides"] = collides
+
+    counts = dict()
+    events = []
+    for z, (name, _) in enumerate(self.zones):
+      counts[name] = int(np.count_nonzero(inside[:, z]))
+
+      occupied = counts[name] > 0
+      if occupied != self.occupied[name]:
+        events.append({"event": "occupied" if occupied else "vacant", "zone": name, "count": counts[name], "time": now})
+        self.occupied[name] = occupied
+
+    return counts, int(np.count_nonzero(in_any)), events
@@ -0,0 +1,235 @@
+import os, time, logging
+import json
+import argparse
+import threading
+import numpy as np
+import cv2
+import imutils
+from shared_memory import SharedMemoryManager
+
+# ***********************************************************************************
+# Detector benchmark
+#
+# Replays a video (or synthetic frames) through every backend directly, and through
+# every transport of the http service in-process, then reports throughput and latency
+# percentiles broken down by stage
+#
+STAGES = ["decode", "preprocess", "inference", "postprocess"]
+TRANSPORTS = ["json", "shared", "raw", "lva"]
+# serialize: client building the request, transfer: round trip less what the service reports
+# for itself (routing, request and response bodies), imgprep and detection: from the response
+TRANSPORT_STAGES = ["serialize", "transfer", "imgprep", "detection"]
+
+# separate from the file camerastream uses so we never clobber a live ring
+benchmark_shm_name = "detector-benchmark"
+benchmark_shm_size = 50 * 1024 * 1024
+
+def load_frames(video_file, count, width=400):
+  '''
+  Decodes up to count frames, resized the way the camera sends them.
+  Falls back to random frames if the video is not there.
+  Returns frames and the decode time of each
+  '''
+  frames, decode_times = [], []
+
+  if video_file is not None and os.path.exists(video_file):
+    capture = cv2.VideoCapture(video_file)
+
+    while len(frames) < count:
+      start = time.time()
+      res, frame = capture.read()
+      if not res:
+        break
+      decode_times.append(time.time() - start)
+      frames.append(imutils.resize(frame, width=width))
+
+    capture.release()
+
+  if len(frames) == 0:
+    logging.warning(f"Could not read {video_file}, using synthetic frames")
+    frames = [np.random.randint(0, 256, (int(width * 0.75), width, 3), dtype=np.uint8) for _ in range(count)]
+    decode_times = [0.] * count
+
+  # loop the video if it is shorter than what we asked for
+  while len(frames) < count:
+    frames += frames[:count - len(frames)]
+    decode_times += decode_times[:count - len(decode_times)]
+
+  return frames, decode_times
+
+def percentiles(values):
+  '''
+  p50/p95/p99 in milliseconds
+  '''
+  if len(values) == 0:
+    return {"p50": 0., "p95": 0., "p99": 0.}
+
+  p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+  return {"p50": p50, "p95": p95, "p99": p99}
+
+def run_concurrently(task, count, concurrency):
+  '''
+  Calls task(i) for i in range(count) from concurrency threads.
+  Returns the latency of every call and the wall time of the whole run
+  '''
+  latencies = [0.] * count
+  next_item = iter(range(count))
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with lock:
+        i = next(next_item, None)
+      if i is None:
+        return
+
+      start = time.time()
+      task(i)
+      latencies[i] = time.time() - start
+
+  start = time.time()
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  return latencies, time.time() - start
+
+def report(name, latencies, wall_time, stages):
+  total = percentiles(latencies)
+  print(f"{name:<32} {len(latencies) / wall_time:8.1f} fps  "
+        f"p50 {total['p50']:7.1f}  p95 {total['p95']:7.1f}  p99 {total['p99']:7.1f} ms")
+
+  for stage, values in stages.items():
+    stage_pct = percentiles(values)
+    print(f"  {stage:<30} {'':12}  p50 {stage_pct['p50']:7.1f}  p95 {stage_pct['p95']:7.1f}  p99 {stage_pct['p99']:7.1f} ms")
+
+def benchmark_backend(name, detector, frames, decode_times, concurrency):
+  stages = {stage: [0.] * len(frames) for stage in STAGES}
+
+  def task(i):
+    timings = dict()
+    detector.detect_batch([frames[i]], timings)
+
+    stages["decode"][i] = decode_times[i]
+    for stage in STAGES[1:]:
+      stages[stage][i] = timings.get(stage, 0.)
+
+  latencies, wall_time = run_concurrently(task, len(frames), concurrency)
+  report(f"{name} x{concurrency}", latencies, wall_time, stages)
+
+def encode_jpegs(frames):
+  '''
+  LVA sends us jpegs, they are encoded up front. Returns them and the encode time of each
+  '''
+  jpegs, encode_times = [], []
+
+  for frame in frames:
+    start = time.time()
+    jpegs.append(cv2.imencode(".jpg", frame)[1].tobytes())
+    encode_times.append(time.time() - start)
+
+  return jpegs, encode_times
+
+def benchmark_transport(name, app, writer_ring, frames, concurrency):
+  '''
+  Posts frames to the service the way camerastream (or LVA for /lva) does,
+  client side serialization included
+  '''
+  clients = threading.local()
+  stages = {stage: [0.] * len(frames) for stage in TRANSPORT_STAGES}
+
+  if name == "lva":
+    jpegs, encode_times = encode_jpegs(frames)
+    # /lva answers in the LVA format, without timings: the service time is all we get
+    stages = {"serialize": encode_times, "service": [0.] * len(frames)}
+
+  def task(i):
+    if not hasattr(clients, "client"):
+      clients.client = app.test_client()
+    client = clients.client
+    frame = frames[i]
+
+    start = time.time()
+    if name == "json":
+      body = json.dumps({"frameId": i, "image_name": None, "img": frame.tolist()})
+      headers = {"Content-Type": "application/json"}
+      query = None
+    elif name == "raw":
+      body = frame.tobytes()
+      headers = {"Content-Type": "application/octet-stream",
+                 "X-Frame-Shape": ','.join(map(str, frame.shape)),
+                 "X-Frame-Dtype": str(frame.dtype), "X-Frame-Id": str(i)}
+      query = None
+    elif name == "shared":
+      slot, seq = writer_ring.WriteFrame(frame, i)
+      body = json.dumps({"frameId": i, "image_name": None})
+      headers = {"Content-Type": "application/json"}
+      query = {"shared": benchmark_shm_name, "slot": slot, "seq": seq}
+    serialize_time = time.time() - start
+
+    start = time.time()
+    if name == "lva":
+      client.post("/lva", data=jpegs[i], headers={"Content-Type": "image/jpeg"})
+      stages["service"][i] = time.time() - start
+      return
+
+    resp = client.post("/detect", data=body, headers=headers, query_string=query)
+    round_trip = time.time() - start
+
+    perf = resp.get_json().get("perf", dict())
+    stages["serialize"][i] = serialize_time
+    stages["imgprep"][i] = perf.get("imgprep", 0.)
+    stages["detection"][i] = perf.get("detection", 0.)
+    stages["transfer"][i] = max(0., round_trip - stages["imgprep"][i] - stages["detection"][i])
+
+  latencies, wall_time = run_concurrently(task, len(frames), concurrency)
+  report(f"{name} x{concurrency}", latencies, wall_time, stages)
+
+def run_benchmark(args, app, service):
+  '''
+  Parameters:
+    args: detector command line, see parse_detector_args()
+    app: the flask app
+    service: the detector module, its detector and shared_ring are swapped for every backend
+  '''
+  logging.getLogger().setLevel(logging.WARNING)
+
+  video_file = None if args.synthetic else args.video
+  frames, decode_times = load_frames(video_file, args.frames)
+  backends = args.backends.split(',') if args.backends is not None else [args.detector]
+  transports = args.transports.split(',')
+  concurrency = [int(c) for c in args.concurrency.split(',')]
+
+  for transport in transports:
+    if transport not in TRANSPORTS:
+      raise ValueError(f"Unknown transport: {transport}")
+
+  shared_manager = SharedMemoryManager(benchmark_shm_name, benchmark_shm_size, create=True)
+  writer_ring = shared_manager.GetRing(max(concurrency) * 2)
+
+  print(f"{len(frames)} frames of {frames[0].shape}, latency percentiles per frame")
+
+  try:
+    for backend in backends:
+      backend_args = argparse.Namespace(**vars(args))
+      backend_args.detector = backend
+      backend_args.test = True
+
+      service.load_detector(backend_args)
+      service.shared_ring = shared_manager.GetRing()
+
+      # first inference pays for lazy initialization
+      service.detector.detect(frames[0])
+
+      print(f"\n--- backend: {backend}")
+      for c in concurrency:
+        benchmark_backend(backend, service.detector, frames, decode_times, c)
+
+      for transport in transports:
+        print(f"\n--- backend: {backend}, transport: {transport}")
+        for c in concurrency:
+          benchmark_transport(transport, app, writer_ring, frames, c)
+  finally:
+    os.remove(os.path.join('/dev/shm', benchmark_shm_name))
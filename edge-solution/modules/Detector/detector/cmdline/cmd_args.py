@@ -7,5 +7,23 @@ def parse_detector_args():
   ap.add_argument("--debug", default=False, action="store_true", help="Invoke remote debugger")
   ap.add_argument("--detector", default="opencv", help="Detector: opencv or openvino")
   ap.add_argument("--device", default="CPU", help="Device: CPU, GPU, MYRIAD")
+  ap.add_argument("--batch-size", default=1, type=int, help="Batch frames from concurrent requests, up to this many per inference")
+  ap.add_argument("--batch-timeout", default=10, type=float, help="Milliseconds to wait for a batch to fill up")
+  ap.add_argument("--num-requests", default=1, type=int, help="OpenVINO infer requests run asynchronously, 0 lets the device decide")
+  ap.add_argument("--nms-threshold", default=None, type=float, help="IoU for an extra class-wise NMS over the detections, off by default")
+  ap.add_argument("--server", default="flask", choices=["flask", "gunicorn"], help="flask development server or gunicorn with a model per worker")
+  ap.add_argument("--host", default="detector", help="Host to listen on")
+  ap.add_argument("--port", default=5010, type=int, help="Port to listen on")
+  ap.add_argument("--workers", default=1, type=int, help="gunicorn worker processes, each loads its own model")
+  ap.add_argument("--request-threads", default=4, type=int, help="Threads serving requests in each gunicorn worker")
+  ap.add_argument("--threads", default=0, type=int, help="Inference threads per worker, 0 leaves it to OpenCV/OpenVINO")
+  ap.add_argument("--pin-workers", default=False, action="store_true", help="Pin each gunicorn worker to its own set of cores")
+  ap.add_argument("--benchmark", default=False, action="store_true", help="Benchmark backends and transports instead of serving")
+  ap.add_argument("--video", default=None, help="Video to replay in the benchmark, video/staircase.mp4 by default")
+  ap.add_argument("--synthetic", default=False, action="store_true", help="Benchmark on random frames instead of a video")
+  ap.add_argument("--frames", default=200, type=int, help="Frames per benchmark run")
+  ap.add_argument("--backends", default=None, help="Comma separated backends to benchmark, defaults to --detector")
+  ap.add_argument("--transports", default="json,shared,raw,lva", help="Comma separated transports to benchmark: json, shared, raw, lva")
+  ap.add_argument("--concurrency", default="1,4", help="Comma separated numbers of concurrent clients")
   args = ap.parse_args()
   return args
\ No newline at end of file
@@ -1,3 +1,5 @@
+import time
+import threading
 import numpy as np
 import cv2
 
@@ -8,15 +10,18 @@ CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat",
 
 COLORS = np.random.uniform(0, 255, size=(len(CLASSES), 3))
 
+# compact per-frame detection results, converted to dicts only when serialized
+DETECTION_DTYPE = np.dtype([("class", np.int32), ("confidence", np.float32), ("bbox", np.float32, (4,))])
+
 def display(frame, detections):	
 
   (h, w) = frame.shape[:2]
 
   for detection in detections:
     # draw the prediction on the frame
-    label = "{}: {:.2f}".format(detection["label"], detection["confidence"])
-    startX, startY, endX, endY = (np.array(detection["bbox"]) * np.array([w, h, w, h])).astype("int")
-    idx = detection["class"]
+    idx = int(detection["class"])
+    label = "{}: {:.2f}".format(CLASSES[idx], detection["confidence"])
+    startX, startY, endX, endY = (detection["bbox"] * np.array([w, h, w, h])).astype("int")
 
     cv2.rectangle(frame, (startX, startY), (endX, endY),
       COLORS[idx], 2)
@@ -26,5 +31,167 @@ def display(frame, detections):
 
   return frame
 
+def add_timing(timings, stage, start):
+  '''
+  Adds the time since start to the stage if we are collecting timings.
+  Returns the current time so stages can be chained
+  '''
+  now = time.time()
+  if timings is not None:
+    timings[stage] = timings.get(stage, 0) + now - start
+  return now
+
 def format_detections(startX, startY, endX, endY, label_idx, confidence):
-  return {"bbox": [float(startX), float(startY), float(endX), float(endY)], "label": CLASSES[label_idx], "confidence": float(confidence), "class": label_idx }
\ No newline at end of file
+  return {"bbox": [float(startX), float(startY), float(endX), float(endY)], "label": CLASSES[label_idx], "confidence": float(confidence), "class": label_idx }
+
+def non_max_suppression(boxes, scores, threshold):
+  '''
+  Greedy NMS over (N, 4) boxes in (startX, startY, endX, endY) format.
+  Returns indices of the boxes kept, highest score first
+  '''
+  areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+  order = np.argsort(-scores)
+  keep = []
+
+  while order.size > 0:
+    i = order[0]
+    keep.append(i)
+
+    # overlap of the best remaining box with all the others
+    x1 = np.maximum(boxes[i, 0], boxes[order[1:], 0])
+    y1 = np.maximum(boxes[i, 1], boxes[order[1:], 1])
+    x2 = np.minimum(boxes[i, 2], boxes[order[1:], 2])
+    y2 = np.minimum(boxes[i, 3], boxes[order[1:], 3])
+    inter = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    iou = inter / (areas[i] + areas[order[1:]] - inter + 1e-9)
+
+    order = order[1:][iou <= threshold]
+
+  return np.array(keep, dtype=np.int64)
+
+def postprocess_detections(detections, batch_size, threshold, class_idx=None, nms_threshold=None):
+  '''
+  Filters raw SSD output for the whole batch at once.
+  Parameters:
+    detections: rows of (image id, class, confidence, startX, startY, endX, endY)
+    batch_size: number of images in the batch
+    threshold: minimum confidence
+    class_idx: only keep this class if set
+    nms_threshold: IoU above which boxes of the same class and image are suppressed, off if None
+  Returns:
+    list with a DETECTION_DTYPE array per image
+  '''
+  detections = detections.reshape(-1, 7)
+
+  # a negative image id marks the end of the valid detections
+  image_ids = detections[:, 0]
+  invalid = np.flatnonzero(image_ids < 0)
+  if invalid.size > 0:
+    detections = detections[:invalid[0]]
+    image_ids = image_ids[:invalid[0]]
+
+  image_ids = image_ids.astype(np.int32)
+  classes = detections[:, 1].astype(np.int32)
+
+  mask = (image_ids < batch_size) & (detections[:, 2] > threshold)
+  if class_idx is not None:
+    mask &= classes == class_idx
+
+  image_ids = image_ids[mask]
+  kept = detections[mask]
+
+  if nms_threshold is not None and len(kept) > 1:
+    # shift boxes of each image/class pair apart so they never overlap each other
+    # and a single NMS pass is class-wise
+    shift = ((image_ids * len(CLASSES) + classes[mask]) * 4).astype(np.float32)
+    keep = np.sort(non_max_suppression(kept[:, 3:7] + shift[:, np.newaxis], kept[:, 2], nms_threshold))
+    kept = kept[keep]
+    image_ids = image_ids[keep]
+
+  results = np.empty(len(kept), dtype=DETECTION_DTYPE)
+  results["class"] = kept[:, 1]
+  results["confidence"] = kept[:, 2]
+  results["bbox"] = kept[:, 3:7]
+
+  # split per image, keeping the network's order within each image
+  order = np.argsort(image_ids, kind="stable")
+  bounds = np.searchsorted(image_ids[order], np.arange(batch_size + 1))
+  results = results[order]
+
+  return [results[bounds[i]:bounds[i + 1]] for i in range(batch_size)]
+
+class TensorPreprocessor:
+  '''
+  Turns frames into the NCHW input of a model in a single pass: each frame is resized once,
+  straight to the model size (not at all if it already is), and written channel first into
+  a tensor that is reused across calls. Every thread gets its own buffers.
+
+  Frames can also come in as a HWC view of a CHW tensor (frame.transpose(1, 2, 0)),
+  they are then copied over as they are.
+  '''
+
+  def __init__(self, width, height, dtype=np.uint8, scale=1., mean=0.):
+    '''
+    Parameters:
+      width, height: model input size
+      dtype: tensor type
+      scale, mean: tensor = (pixel - mean) * scale, only applied to float tensors.
+        mean is a number or one value per channel
+    '''
+    self.width = width
+    self.height = height
+    self.dtype = np.dtype(dtype)
+    self.scale = scale
+    self.offset = (np.broadcast_to(np.asarray(mean, dtype=np.float32), (3,)) * scale).reshape(3, 1, 1)
+
+    self.local = threading.local()
+
+  def buffers(self, batch_size):
+    tensor = getattr(self.local, "tensor", None)
+
+    if tensor is None or len(tensor) < batch_size:
+      self.local.tensor = np.zeros((batch_size, 3, self.height, self.width), dtype=self.dtype)
+      self.local.resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+    return self.local.tensor, self.local.resized
+
+  def __call__(self, frames, batch_size=None):
+    '''
+    Returns the tensor for the frames, valid until the next call from the same thread.
+    Passing batch_size returns that many rows whatever the number of frames
+    '''
+    batch_size = len(frames) if batch_size is None else batch_size
+    tensor, resized = self.buffers(batch_size)
+
+    for i, frame in enumerate(frames):
+      if frame.shape[:2] != (self.height, self.width):
+        frame = cv2.resize(frame, (self.width, self.height), dst=resized)
+
+      if self.dtype.kind == "f":
+        np.multiply(frame.transpose((2, 0, 1)), self.scale, out=tensor[i], casting="unsafe")
+        tensor[i] -= self.offset
+      else:
+        tensor[i] = frame.transpose((2, 0, 1))
+
+    return tensor[:batch_size]
+
+  def model_tensor(self, frame):
+    '''
+    Returns the frame as a (1, C, H, W) view if it already is the model input: a HWC view of a
+    contiguous, model sized CHW tensor of our type. None if it has to go through preprocessing
+    '''
+    tensor = frame.transpose((2, 0, 1))
+
+    if tensor.shape != (3, self.height, self.width) or tensor.dtype != self.dtype or not tensor.flags.c_contiguous:
+      return None
+    if self.dtype.kind == "f" and (self.scale != 1. or np.any(self.offset != 0)):
+      return None
+
+    return tensor[np.newaxis]
+
+def detections_to_dicts(detections):
+  '''
+  Converts a DETECTION_DTYPE array into the json friendly format we send out
+  '''
+  return [format_detections(*bbox, idx, confidence) for idx, confidence, bbox in
+          zip(detections["class"].tolist(), detections["confidence"].tolist(), detections["bbox"].tolist())]
@@ -1,14 +1,19 @@
 import os
+import sys
 import cv2
 import logging
 import time
+import threading
+from concurrent.futures import Future
+from queue import Queue, Empty
 from videostream import VideoStream
 import numpy as np
 import json
-from common import display
+from common import display, detections_to_dicts
 from shared_memory import SharedMemoryManager
+import metrics
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 # for HTTP/1.1 support
 from werkzeug.serving import WSGIRequestHandler
 
@@ -17,6 +22,8 @@ app = Flask(__name__)
 # 50 MB of shared memory for image storage
 shm_size = 50 * 1024 * 1024
 image_file_handle = "image"
+# label of the inference metrics
+detector_backend = None
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
@@ -39,7 +46,7 @@ def main_debug(displaying):
     #logging.info(detections)
 
     if not displaying:
-      logging.info(detections)
+      logging.info(detections_to_dicts(detections))
       continue
 
     frame = display(frame, detections)
@@ -54,30 +61,177 @@ def main_debug(displaying):
   
   cv2.destroyAllWindows()
 
-def get_detector_shared_manager(detector_type, device="CPU", precision="FP32", init_shared_mem=True):
+class BatchingDetector:
+  '''
+  Collects frames from concurrent requests and runs them through
+  the wrapped detector as a single batch
+  '''
+
+  def __init__(self, detector, max_batch=8, max_wait_ms=10, workers=1):
+    '''
+    Parameters:
+      detector: Detector or OpenVinoDetector
+      max_batch: largest number of frames in one forward pass
+      max_wait_ms: how long to wait for more frames once the first one arrives
+      workers: number of batches in flight, useful when the detector runs inferences in parallel
+    '''
+    self.detector = detector
+    self.max_batch = max_batch
+    self.max_wait = max_wait_ms / 1000.
+
+    self.pending = Queue()
+    self.batchers = []
+    for _ in range(workers):
+      batcher = threading.Thread(target=self.run_batches)
+      batcher.daemon = True
+      batcher.start()
+      self.batchers.append(batcher)
+
+    logging.info(f"Batching up to {max_batch} frames, waiting at most {max_wait_ms} ms, {workers} batches in flight")
+
+  def detect(self, frame):
+    future = Future()
+    self.pending.put((frame, future))
+
+    # block until the batch that picked up our frame is done
+    return future.result()
+
+  def detect_batch(self, frames, timings=None):
+    return self.detector.detect_batch(frames, timings)
+
+  def collect_batch(self):
+    batch = [self.pending.get()]
+    deadline = time.time() + self.max_wait
+
+    while len(batch) < self.max_batch:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      try:
+        batch.append(self.pending.get(timeout=remaining))
+      except Empty:
+        break
+
+    return batch
+
+  def run_batches(self):
+    while True:
+      batch = self.collect_batch()
+      metrics.batch_size.labels(detector_backend).observe(len(batch))
+
+      try:
+        results = self.detector.detect_batch([frame for frame, _ in batch])
+      except Exception as e:
+        logging.error(f"Batch of {len(batch)} frames failed: {e}")
+        for _, future in batch:
+          future.set_exception(e)
+        continue
+
+      for (_, future), detections in zip(batch, results):
+        future.set_result(detections)
+
+def main_benchmark(args):
+  '''
+  Replays video through the backends and transports, see benchmark.py
+  '''
+  from benchmark import run_benchmark
+
+  if args.video is None:
+    args.video = os.path.join(os.path.dirname(__file__), "video/staircase.mp4")
+
+  run_benchmark(args, app, sys.modules[__name__])
+
+def get_detector_shared_manager(detector_type, device="CPU", precision="FP32", init_shared_mem=True, batch_size=1, batch_timeout=10, num_requests=1,
+                                nms_threshold=None, threads=0):
   try:
     if init_shared_mem:
-      shared_manager = SharedMemoryManager(image_file_handle, shm_size)
+      # camerastream formats the ring, we only read the layout it wrote
+      shared_manager = SharedMemoryManager(image_file_handle, shm_size).GetRing()
     else:
       shared_manager = None
   except:
     logging.warn("Shared memory not present")
     raise
 
+  # inference threads of this process, 0 leaves it to the libraries
+  if threads > 0:
+    cv2.setNumThreads(threads)
+
   if detector_type == "opencv":
     from ssd_object_detection import Detector
 
-    detector = Detector(use_gpu=True, people_only=True)
+    detector = Detector(use_gpu=True, people_only=True, nms_threshold=nms_threshold)
   elif detector_type == "openvino":
     from ssd_object_detection_openvino import OpenVinoDetector
 
-    detector = OpenVinoDetector(device_name=device)
+    detector = OpenVinoDetector(device_name=device, batch_size=batch_size, num_requests=num_requests,
+                                nms_threshold=nms_threshold, threads=threads)
   else:
     raise ValueError("Unknown detector type")
 
+  if batch_size > 1:
+    # keep every infer request busy with its own batch
+    workers = getattr(detector, "num_requests", 1)
+    detector = BatchingDetector(detector, batch_size, batch_timeout, workers)
+
   return shared_manager, detector
 
-def start_app():
+def load_detector(args):
+  global shared_ring, detector, detector_backend
+
+  shared_ring, detector = get_detector_shared_manager(args.detector, args.device, "FP16", init_shared_mem=not args.test,
+                                                     batch_size=args.batch_size, batch_timeout=args.batch_timeout,
+                                                     num_requests=args.num_requests, nms_threshold=args.nms_threshold,
+                                                     threads=args.threads)
+  detector_backend = args.detector
+
+  if shared_ring is not None:
+    metrics.shm_slots.set(shared_ring.slotCount)
+
+def assign_worker_slot(server, worker):
+  '''
+  Runs in the gunicorn master before the fork: hands the new worker the lowest slot no live
+  worker holds, so a respawned worker takes over the cores of the one it replaces
+  '''
+  taken = set(getattr(live_worker, "slot", None) for live_worker in server.WORKERS.values())
+  worker.slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+
+def init_worker(worker, args):
+  '''
+  Every gunicorn worker loads its own model after the fork
+  '''
+  if args.pin_workers:
+    # give each worker its own slice of the cores
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cores) // args.workers)
+    idx = worker.slot % args.workers
+    worker_cores = cores[idx * per_worker:(idx + 1) * per_worker] or cores
+    os.sched_setaffinity(0, worker_cores)
+    logging.info(f"Worker {worker.pid} pinned to cores {worker_cores}")
+
+  load_detector(args)
+
+def start_gunicorn(args):
+  from gunicorn.app.base import BaseApplication
+
+  class DetectorServer(BaseApplication):
+    def load_config(self):
+      self.cfg.set("bind", f"{args.host}:{args.port}")
+      self.cfg.set("workers", args.workers)
+      # request threads let batching and async inference work within a worker
+      self.cfg.set("worker_class", "gthread")
+      self.cfg.set("threads", args.request_threads)
+      self.cfg.set("keepalive", 60)
+      self.cfg.set("pre_fork", assign_worker_slot)
+      self.cfg.set("post_worker_init", lambda worker: init_worker(worker, args))
+      self.cfg.set("child_exit", metrics.worker_exit)
+
+    def load(self):
+      return app
+
+  DetectorServer().run()
+
+def start_app(args):
 
     # set protocol to 1.1 so we keep the connection open
     WSGIRequestHandler.protocol_version = "HTTP/1.1"
@@ -88,7 +242,11 @@ def start_app():
       ptvsd.wait_for_attach()
       ptvsd.break_into_debugger()
 
-    app.run(debug=False, host="detector", port=5010)
+    if args.server == "gunicorn":
+      start_gunicorn(args)
+    else:
+      load_detector(args)
+      app.run(debug=False, host=args.host, port=args.port)
 
 @app.route("/lva", methods=["POST"])
 def detect_in_frame_lva():
@@ -98,43 +256,116 @@ def detect_in_frame_lva():
 
   img = cv2.imdecode(narr, cv2.IMREAD_COLOR)
   
+  start = time.time()
   detections = detector.detect(img)
 
+  metrics.requests_total.labels("lva").inc()
+  metrics.inference_seconds.labels(detector_backend).observe(time.time() - start)
+
   results = dict()
-  results["inferences"] = detections
+  results["inferences"] = detections_to_dicts(detections)
   return jsonify(results)
 
+@app.route("/metrics", methods=["GET"])
+def serve_metrics():
+  body, content_type = metrics.render_metrics()
+  return Response(body, content_type=content_type)
+
+def stale_slot_response(slot, seq):
+  metrics.shm_stale_total.inc()
+  logging.warning(f"Shared memory slot {slot} no longer holds frame sequence {seq}")
+  return jsonify({"error": "stale shared memory slot", "slot": slot, "seq": seq}), 409
+
+def read_raw_frame():
+  '''
+  Frame is posted as raw bytes with its layout in the headers,
+  wrap the request body without copying it. Raises ValueError on headers that do not describe the body
+  '''
+  if "X-Frame-Shape" not in request.headers:
+    raise ValueError("missing X-Frame-Shape header")
+
+  try:
+    shape = tuple(map(int, request.headers["X-Frame-Shape"].split(',')))
+    dtype = np.dtype(request.headers.get("X-Frame-Dtype", "uint8"))
+  except TypeError as e:
+    raise ValueError(f"bad X-Frame-Dtype header: {e}")
+
+  if len(shape) not in (2, 3) or min(shape) <= 0:
+    raise ValueError(f"bad X-Frame-Shape header: {shape}")
+
+  body = request.get_data()
+  if len(body) != int(np.prod(shape)) * dtype.itemsize:
+    raise ValueError(f"body of {len(body)} bytes does not hold a {dtype} frame of shape {shape}")
+
+  frame = np.frombuffer(body, dtype=dtype).reshape(shape)
+
+  data = {"frameId": request.headers.get("X-Frame-Id", -1, type=int),
+          "image_name": request.headers.get("X-Image-Name")}
+  return data, frame
+
 @app.route("/detect", methods=["POST"])
 def detect_in_frame():
   
-  # we are sending a json object
   start = time.time()
+  shared_file = request.args.get("shared")
+  slot = None
+
+  if request.mimetype == "application/octet-stream":
+    transport = "raw"
+    try:
+      data, frame = read_raw_frame()
+    except ValueError as e:
+      # a client bug, not a detector failure
+      return jsonify({"error": str(e)}), 400
+  else:
+    # we are sending a json object
+    data = request.get_json()
+
+    if  shared_file is None:
+      transport = "json"
+      frame = np.array(data['img']).astype('uint8')
+    else:
+      transport = "shared"
+      # by now camerastream has already written the frame into its ring slot
+      slot = request.args.get("slot", type=int)
+      seq = request.args.get("seq", type=int)
+
+      try:
+        frame = shared_ring.ReadFrame(slot, seq)
+      except (TypeError, ValueError) as e:
+        # no or out of range slot, or a descriptor we cannot make sense of
+        return jsonify({"error": str(e), "slot": slot, "seq": seq}), 400
+
+      if frame is None:
+        return stale_slot_response(slot, seq)
+      metrics.shm_slots.set(shared_ring.slotCount)
+
+      metrics.shm_frame_age_seconds.observe(time.time() - shared_ring.ReadDescriptor(slot)["timestamp"])
+
+  # camerastream already laid the frame out as the model input, channel first
+  if request.args.get("layout") == "chw":
+    frame = frame.transpose((1, 2, 0))
 
-  data = request.get_json()
-  
   prep_time = time.time() - start
-  shared_file = request.args.get("shared")
-  shared_size = request.args.get("size")
   
   results = {'frameId': data['frameId'], 'image_name': data['image_name']}
 
-  if  shared_file is None:
-    frame = np.array(data['img']).astype('uint8')
-  else:
-    # by now camerastream has already initialzed shared memory
-    h, w, c = tuple(map(int, shared_size.split(',')))
-    im_size = h * w * c
+  detections = detector.detect(frame)
 
-    frame_bytes = shared_manager.ReadBytes(0, im_size)
-    frame = np.frombuffer(frame_bytes, dtype=np.uint8, count=im_size).reshape((h, w, c))
+  # the frame is read in place, make sure it was not overwritten while we were at it
+  if slot is not None and not shared_ring.IsCurrent(slot, seq):
+    return stale_slot_response(slot, seq)
 
-  detections = detector.detect(frame)
   total_time = time.time() - start
   detection_time = total_time - prep_time 
 
   perf = {"imgprep": prep_time, "detection": detection_time}
 
-  results["detections"] = detections
+  metrics.requests_total.labels(transport).inc()
+  metrics.imgprep_seconds.labels(transport).observe(prep_time)
+  metrics.inference_seconds.labels(detector_backend).observe(detection_time)
+
+  results["detections"] = detections_to_dicts(detections)
   results["perf"] = perf
   
   logging.info(f"detected objects: {json.dumps(results, indent=1)}")
@@ -148,10 +379,11 @@ if __name__== "__main__":
   debug = args.debug
   local = args.test
 
-  shared_manager, detector = get_detector_shared_manager(args.detector, args.device, "FP16", init_shared_mem=not local)
-
-  if local:
+  if args.benchmark:
+    main_benchmark(args)
+  elif local:
+    load_detector(args)
     main_debug(args.display)
   else:
-    start_app()  
+    start_app(args)
   
@@ -0,0 +1,43 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# ***********************************************************************************
+# Prometheus metrics served on /metrics, next to /detect on the detector port (5010). The
+# deployment publishes that port on the loopback of the edge box only, so /detect does not
+# reach the network: scrape http://127.0.0.1:5010/metrics from the box itself
+#
+# With several gunicorn workers set PROMETHEUS_MULTIPROC_DIR (an empty directory) in the
+# environment, every worker then writes its samples there and /metrics adds them up
+#
+latency_buckets = (.005, .01, .025, .05, .075, .1, .15, .25, .5, 1., 2.5, 5.)
+
+requests_total = Counter("detector_requests_total", "Detection requests", ["transport"])
+imgprep_seconds = Histogram("detector_imgprep_seconds", "Time to get the frame out of the request", ["transport"],
+                            buckets=latency_buckets)
+inference_seconds = Histogram("detector_inference_seconds", "Detection time per frame, batching wait included", ["backend"],
+                              buckets=latency_buckets)
+batch_size = Histogram("detector_batch_size", "Frames per forward pass", ["backend"], buckets=(1, 2, 4, 8, 16, 32))
+shm_stale_total = Counter("detector_shm_stale_total", "Shared memory frames overwritten before we were done with them")
+shm_frame_age_seconds = Histogram("detector_shm_frame_age_seconds", "Time between camerastream writing a slot and us reading it",
+                                  buckets=latency_buckets)
+shm_slots = Gauge("detector_shm_slots", "Slots in the shared memory ring", multiprocess_mode="max")
+
+def render_metrics():
+  '''
+  Returns the text exposition and its content type
+  '''
+  if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+
+  return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def worker_exit(server, worker):
+  '''
+  gunicorn child_exit hook, drops the samples of live gauges of a dead worker
+  '''
+  if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    multiprocess.mark_process_dead(worker.pid)
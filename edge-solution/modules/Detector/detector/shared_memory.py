@@ -2,14 +2,18 @@ import tempfile
 import mmap
 import os
 import logging
+import struct
+import threading
+import time
+import numpy as np
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
 # ***********************************************************************************
-# Shared memory management 
+# Shared memory management
 #
 class SharedMemoryManager:
-    def __init__(self, name, size):
+    def __init__(self, name, size, create=False):
         try:
             self._shmFilePath = '/dev/shm'
             self._shmFileName = name
@@ -18,7 +22,14 @@ class SharedMemoryManager:
 
             self._shmFileFullPath = os.path.join(self._shmFilePath, self._shmFileName)
 
-            self._shmFile = open(self._shmFileFullPath, 'r+b')            
+            # the producer (camerastream) creates and zeroes the file,
+            # consumers map the existing one
+            if create:
+                self._shmFile = open(self._shmFileFullPath, 'wb+')
+                self._shmFile.write(bytearray(self._shmFileSize))
+                self._shmFile.flush()
+            else:
+                self._shmFile = open(self._shmFileFullPath, 'r+b')
             self._shm = mmap.mmap(self._shmFile.fileno(), self._shmFileSize)
 
             self._memSlots = dict()
@@ -42,9 +53,174 @@ class SharedMemoryManager:
             logging.error(e)
             raise
 
+    def GetRing(self, slotCount=None):
+        '''
+        Returns a ring buffer view over the shared memory file.
+        Passing slotCount (producer side) formats the file, consumers leave it None
+        '''
+        return SharedMemoryRing(self._shm, slotCount)
+
     def __del__(self):
-        try:            
+        try:
             self._shmFile.close()
         except Exception as e:
             logging.error(e)
             raise
+
+# ***********************************************************************************
+# Multi-slot frame ring on top of shared memory
+#
+# Layout:
+#   header     | magic, version, slot count, slot size, data offset
+#   slot table | one descriptor per slot: sequence, frame id, timestamp, size, dtype, shape
+#   data       | slot count * slot size bytes of frame data
+#
+# Each slot is guarded by a seqlock: the sequence number is odd while the slot is being
+# written and even once the frame is complete. The producer hands (slot, sequence) to
+# the consumer, who only trusts the frame as long as the sequence has not moved.
+#
+class SharedMemoryRing:
+    MAGIC = b'SCRB'
+    VERSION = 1
+    MAX_DIMS = 4
+
+    _headerFormat = struct.Struct('<4sIIQQ')
+    _headerSize = 64
+    # sequence, frame id, timestamp, nbytes, ndim, dtype, shape
+    _slotFormat = struct.Struct('<QqdQI8s4I')
+    _slotSize = 64
+
+    def __init__(self, buffer, slotCount=None):
+        self._buffer = buffer
+        self._lock = threading.Lock()
+        self._nextSlot = 0
+
+        self.slotCount = 0
+        self.slotSize = 0
+        self._dataOffset = 0
+
+        if slotCount is not None:
+            self._Format(slotCount)
+        else:
+            self._ReadHeader()
+
+    def _Format(self, slotCount):
+        if slotCount <= 0:
+            raise ValueError("slot count should be positive")
+
+        dataOffset = self._headerSize + slotCount * self._slotSize
+        # keep every slot 64 byte aligned
+        slotSize = ((len(self._buffer) - dataOffset) // slotCount) & ~63
+
+        if slotSize <= 0:
+            raise ValueError(f"Shared memory is too small for {slotCount} slots")
+
+        # zero out the slot table so that stale sequence numbers from
+        # a previous run are never mistaken for live frames
+        self._buffer[self._headerSize:dataOffset] = bytes(dataOffset - self._headerSize)
+        self._headerFormat.pack_into(self._buffer, 0, self.MAGIC, self.VERSION, slotCount, slotSize, dataOffset)
+
+        self.slotCount = slotCount
+        self.slotSize = slotSize
+        self._dataOffset = dataOffset
+        logging.info(f"Shared memory ring: {slotCount} slots of {slotSize} bytes")
+
+    def _ReadHeader(self):
+        magic, version, slotCount, slotSize, dataOffset = self._headerFormat.unpack_from(self._buffer, 0)
+
+        # the producer may not have formatted the memory yet
+        if magic != self.MAGIC:
+            return False
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported shared memory ring version: {version}")
+
+        self.slotCount = slotCount
+        self.slotSize = slotSize
+        self._dataOffset = dataOffset
+        return True
+
+    def _SlotOffset(self, slot):
+        return self._headerSize + slot * self._slotSize
+
+    def _Sequence(self, slot):
+        return struct.unpack_from('<Q', self._buffer, self._SlotOffset(slot))[0]
+
+    def _SetSequence(self, slot, seq):
+        struct.pack_into('<Q', self._buffer, self._SlotOffset(slot), seq)
+
+    def _AcquireSlot(self):
+        with self._lock:
+            slot = self._nextSlot
+            self._nextSlot = (self._nextSlot + 1) % self.slotCount
+        return slot
+
+    def WriteFrame(self, frame, frameId=-1, timestamp=None):
+        '''
+        Copies the frame into the next slot of the ring, timestamp defaults to now.
+        Returns (slot, sequence) identifying the frame for the consumer
+        '''
+        frame = np.ascontiguousarray(frame)
+
+        if frame.ndim > self.MAX_DIMS:
+            raise ValueError(f"Frames can have at most {self.MAX_DIMS} dimensions")
+        if frame.nbytes > self.slotSize:
+            raise ValueError(f"Frame of {frame.nbytes} bytes does not fit into a {self.slotSize} byte slot")
+
+        slot = self._AcquireSlot()
+        offset = self._SlotOffset(slot)
+
+        # odd sequence: slot is being written
+        seq = self._Sequence(slot) + 1
+        self._SetSequence(slot, seq)
+
+        start = self._dataOffset + slot * self.slotSize
+        self._buffer[start:start + frame.nbytes] = frame.data.cast('B')
+
+        shape = tuple(frame.shape) + (0,) * (self.MAX_DIMS - frame.ndim)
+        timestamp = time.time() if timestamp is None else timestamp
+        self._slotFormat.pack_into(self._buffer, offset, seq, frameId, timestamp, frame.nbytes,
+                                   frame.ndim, frame.dtype.str.encode('ascii'), *shape)
+
+        # even sequence: slot is complete
+        seq += 1
+        self._SetSequence(slot, seq)
+
+        return slot, seq
+
+    def ReadFrame(self, slot, seq):
+        '''
+        Zero-copy view of the frame in the slot.
+        Returns None if the slot no longer holds the frame with this sequence number.
+        The view is only valid as long as IsCurrent(slot, seq) holds, so check it again
+        once done with the frame
+        '''
+        # the producer may have restarted with another layout since the last read,
+        # the slot table would still match but the frame data would not
+        if not self._ReadHeader():
+            return None
+        if slot < 0 or slot >= self.slotCount:
+            raise ValueError(f"Slot {slot} out of range")
+
+        curSeq, _, _, nbytes, ndim, dtype, *shape = self._slotFormat.unpack_from(self._buffer, self._SlotOffset(slot))
+
+        if curSeq != seq or curSeq % 2 != 0:
+            return None
+
+        dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        start = self._dataOffset + slot * self.slotSize
+        frame = np.frombuffer(self._buffer, dtype=dtype, count=nbytes // dtype.itemsize, offset=start)
+        frame = frame.reshape(shape[:ndim])
+
+        return frame
+
+    def ReadDescriptor(self, slot):
+        '''
+        Returns the slot descriptor: sequence, frame id, timestamp, size, dtype, shape
+        '''
+        seq, frameId, timestamp, nbytes, ndim, dtype, *shape = self._slotFormat.unpack_from(self._buffer, self._SlotOffset(slot))
+
+        return {"seq": seq, "frameId": frameId, "timestamp": timestamp, "nbytes": nbytes,
+                "dtype": dtype.rstrip(b'\0').decode('ascii'), "shape": tuple(shape[:ndim])}
+
+    def IsCurrent(self, slot, seq):
+        return self._Sequence(slot) == seq
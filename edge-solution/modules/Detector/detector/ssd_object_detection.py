@@ -4,10 +4,11 @@
 
 # import the necessary packages
 import numpy as np
-import imutils
 import cv2
 import os, logging
-from common import CLASSES, COLORS, format_detections
+import time
+import threading
+from common import CLASSES, COLORS, postprocess_detections, add_timing, TensorPreprocessor
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
@@ -17,15 +18,22 @@ class Detector:
 # detect, then generate a set of bounding box colors for each class
 
   # load our serialized model from disk
-  def __init__(self, use_gpu=True, confidence=0.5, people_only=True):
+  def __init__(self, use_gpu=True, confidence=0.5, people_only=True, nms_threshold=None):
     self.confidence = confidence
+    self.nms_threshold = nms_threshold
     
     prototxt = os.path.join(os.path.dirname(__file__), "net/caffe/MobileNetSSD_deploy.prototxt")
     caffemodel = os.path.join(os.path.dirname(__file__), "net/caffe/MobileNetSSD_deploy.caffemodel")
 
     self.net = cv2.dnn.readNetFromCaffe(prototxt, caffemodel)
+    # setInput/forward on one net from several request threads would mix up their results
+    self.net_lock = threading.Lock()
     self.class_idx = None
 
+    # what blobFromImages(frames, 0.007843, (300, 300), 127.5) does, without the copies.
+    # A scalar mean there is Scalar(127.5, 0, 0), only the first channel is centered
+    self.preprocess = TensorPreprocessor(300, 300, np.float32, scale=0.007843, mean=(127.5, 0, 0))
+
     # we are interested in detecting people only
     if people_only:
       self.class_idx = CLASSES.index("person")
@@ -41,46 +49,37 @@ class Detector:
         logging.warn("Could not set the backend to CUDA")
 
   def detect(self, frame):
+    return self.detect_batch([frame])[0]
+
+  def detect_batch(self, frames, timings=None):
+      '''
+      timings: if a dict is passed, time spent per stage is added to it
+      '''
+      start = time.time()
 
-      # resize the frame, grab the frame dimensions, and convert it to
-      # a blob
-      frame = imutils.resize(frame, width=400)
-      blob = cv2.dnn.blobFromImage(frame, 0.007843, (300, 300), 127.5)
+      # resize the frames straight to the network size and convert them to
+      # a single blob
+      blob = self.preprocess(frames)
+      start = add_timing(timings, "preprocess", start)
 
       # pass the blob through the network and obtain the detections and
       # predictions
-      self.net.setInput(blob)
-      try:
-        detections = self.net.forward()
-      except:
-        
-        logging.warn("Could not run on GPU. Switching to CPU")
-        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
-        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-
-        detections = self.net.forward()
-
-      # loop over the detections
-      results = []
-      for i in np.arange(0, detections.shape[2]):
-        # extract the confidence (i.e., probability) associated with
-        # the prediction
-        confidence = detections[0, 0, i, 2]
-
-        # filter out weak detections by ensuring the `confidence` is
-        # greater than the minimum confidence
-        if confidence > self.confidence:
-          # extract the index of the class label from the
-          # `detections`, then compute the (x, y)-coordinates of
-          # the bounding box for the object
-          idx = int(detections[0, 0, i, 1])
-
-          # filter out people only if that's what we are detecting
-          if self.class_idx is not None and idx != self.class_idx:
-            continue
+      with self.net_lock:
+        self.net.setInput(blob)
+        try:
+          detections = self.net.forward()
+        except:
           
-          [startX, startY, endX, endY] = detections[0, 0, i, 3:7].astype("float")
+          logging.warn("Could not run on GPU. Switching to CPU")
+          self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
+          self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+          detections = self.net.forward()
+
+      start = add_timing(timings, "inference", start)
 
-          results.append(format_detections(startX, startY, endX, endY, idx, confidence))
+      # filter the detections of the whole batch at once
+      results = postprocess_detections(detections[0, 0], len(frames), self.confidence, self.class_idx, self.nms_threshold)
+      add_timing(timings, "postprocess", start)
 
       return results
@@ -15,17 +15,18 @@
  limitations under the License.
 """
 import os
-import cv2
-import numpy as np
 import logging
-from openvino.inference_engine import IECore
-from common import CLASSES, format_detections
+import threading
+from queue import Queue
+from openvino.inference_engine import IECore, Blob, TensorDesc
+import time
+from common import CLASSES, postprocess_detections, add_timing, TensorPreprocessor
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
 
 class OpenVinoDetector:
-  def __init__(self, device_name="CPU", threshold=0.5, people_only=False, precision='FP32'):
+  def __init__(self, device_name="CPU", threshold=0.5, people_only=False, precision='FP32', batch_size=1, num_requests=1, nms_threshold=None, threads=0):
 
     model_path = f"net/openvino/{precision}"
     model_name = os.path.join(model_path, "mobilenet-ssd.xml")
@@ -35,19 +36,19 @@ class OpenVinoDetector:
     self.net = ie.read_network(model=model_name, weights=model_weights)
     logging.info("Read SSD model")
 
-    self.exec_net = ie.load_network(network=self.net, device_name=device_name)
-    logging.info(f"Loaded model to {device_name}")
+    # batches smaller than the network batch size are only
+    # supported through dynamic batching of the CPU plugin
+    self.dynamic_batch = batch_size > 1 and device_name == "CPU"
+    config = dict()
 
-    logging.info(f"Model precision: {precision}")
-    logging.info(f"Detection threshold: {threshold}")
+    if self.dynamic_batch:
+      self.net.batch_size = batch_size
+      config["DYN_BATCH_ENABLED"] = "YES"
+    elif batch_size > 1:
+      logging.warn(f"Batching is not supported on {device_name}, running one frame at a time")
 
-    self.threshold = threshold
-    self.class_idx = None
-
-    # we are interested in detecting people only
-    if people_only:
-      self.class_idx = CLASSES.index("person")
-    
+    if threads > 0 and device_name == "CPU":
+      config["CPU_THREADS_NUM"] = str(threads)
 
     # extract input info from the model
     for input_key in self.net.input_info:
@@ -60,44 +61,125 @@ class OpenVinoDetector:
         self.n, self.c, self.h, self.w = self.net.input_info[input_key].input_data.shape
 
       logging.info("Batch size is {}".format(self.net.batch_size))
+      # has to be set before loading, the executable network keeps the input format it was loaded with
       self.net.input_info[input_key].precision = 'U8'
+      self.net.input_info[input_key].layout = 'NCHW'
+
+    # num_requests = 0 lets the plugin pick the optimal number of requests
+    self.exec_net = ie.load_network(network=self.net, device_name=device_name, config=config, num_requests=num_requests)
+    logging.info(f"Loaded model to {device_name}")
+
+    # pool of idle infer requests. With more than one, requests run asynchronously
+    # so that callers can prepare the next frame while the previous one is inferred
+    self.num_requests = len(self.exec_net.requests)
+    self.async_mode = self.num_requests > 1
+    self.free_requests = Queue()
+    self.request_done = [threading.Event() for _ in range(self.num_requests)]
+    self.request_status = [0] * self.num_requests
+
+    for request_id, request in enumerate(self.exec_net.requests):
+      self.free_requests.put(request_id)
+      if self.async_mode:
+        request.set_completion_callback(self.on_request_complete, request_id)
+
+    logging.info(f"Infer requests: {self.num_requests}, async: {self.async_mode}")
+
+    logging.info(f"Model precision: {precision}")
+    logging.info(f"Detection threshold: {threshold}")
+
+    self.threshold = threshold
+    self.nms_threshold = nms_threshold
+    self.class_idx = None
+
+    # we are interested in detecting people only
+    if people_only:
+      self.class_idx = CLASSES.index("person")
+
+    self.preprocess = TensorPreprocessor(self.w, self.h)
+
+    # input blob each request owns, put back after a request read its input in place
+    self.input_desc = TensorDesc("U8", [1, self.c, self.h, self.w], "NCHW")
+    self.input_blobs = [request.input_blobs[self.input_name] for request in self.exec_net.requests]
+
+  def on_request_complete(self, status, request_id):
+    self.request_status[request_id] = status
+    self.request_done[request_id].set()
+
+  def infer(self, images, out_blob, batch_size, in_place=False):
+    '''
+    Runs the input on the next idle infer request, blocks until one is available.
+    in_place: the request reads images where they are (shared memory) instead of copying them
+      into its input blob. images has to stay untouched until we return
+    '''
+    request_id = self.free_requests.get()
+    request = self.exec_net.requests[request_id]
+
+    if in_place:
+      request.set_blob(self.input_name, Blob(self.input_desc, images))
+      data = None
+    else:
+      data = {self.input_name: images}
+
+    try:
+      if self.dynamic_batch:
+        request.set_batch(batch_size)
+
+      if self.async_mode:
+        done = self.request_done[request_id]
+        done.clear()
+        self.exec_net.start_async(request_id=request_id, inputs=data)
+        done.wait()
+
+        if self.request_status[request_id] != 0:
+          raise RuntimeError(f"Infer request {request_id} failed with status {self.request_status[request_id]}")
+      else:
+        request.infer(data)
+
+      # output buffer belongs to the request, copy it before the request is reused
+      return request.output_blobs[out_blob].buffer.copy()
+    finally:
+      # otherwise the next input would be copied into the caller's memory
+      if in_place:
+        request.set_blob(self.input_name, self.input_blobs[request_id])
+      self.free_requests.put(request_id)
 
   def detect(self, frame):
-    # need it to be in CHW format
-    image = cv2.resize(frame, (self.w, self.h))
-    image = image.transpose((2, 0, 1))
-    image = image[np.newaxis, :]
+    return self.detect_batch([frame])[0]
+
+  def detect_batch(self, frames, timings=None):
+    '''
+    timings: if a dict is passed, time spent per stage is added to it
+    '''
+    if len(frames) > self.n:
+      results = []
+      for i in range(0, len(frames), self.n):
+        results += self.detect_batch(frames[i:i + self.n], timings)
+      return results
+
+    start = time.time()
+
+    # camerastream may have written the frame as the model input already, then we infer it
+    # straight from shared memory. Only for single frame requests, batches need their own tensor
+    images = self.preprocess.model_tensor(frames[0]) if len(frames) == 1 and self.n == 1 else None
+    # the blob would point OpenVINO at memory it must not write to (raw request bodies)
+    in_place = images is not None and images.flags.writeable
+
+    if not in_place:
+      # need it to be in NCHW format, the request always takes a full batch
+      images = self.preprocess(frames, self.n)
 
     # --------------------------- 4. Configure input & output ---------------------------------------------
     # --------------------------- Prepare input blobs -----------------------------------------------------
     out_blob = next(iter(self.net.outputs))
-
-    data = dict()
-    data[self.input_name] = image
+    start = add_timing(timings, "preprocess", start)
 
     # --------------------------- Performing inference ----------------------------------------------------
-    res = self.exec_net.infer(inputs=data)
+    res = self.infer(images, out_blob, len(frames), in_place)
+    start = add_timing(timings, "inference", start)
     # -----------------------------------------------------------------------------------------------------
 
     # --------------------------- Read and postprocess output ---------------------------------------------
-    res = res[out_blob]
-    data = res[0][0]
-
-    results = []
-
-    for _, proposal in enumerate(data):
-      if proposal[2] > self.threshold:
-          idx = np.int(proposal[1])
-          # filter out people only if that's what we are detecting
-          if self.class_idx is not None and idx != self.class_idx:
-              continue
-
-          confidence = proposal[2]
-          xmin = proposal[3]
-          ymin = proposal[4]
-          xmax = proposal[5]
-          ymax = proposal[6]
-
-          results.append(format_detections(xmin, ymin, xmax, ymax, idx, confidence))
+    results = postprocess_detections(res[0][0], len(frames), self.threshold, self.class_idx, self.nms_threshold)
+    add_timing(timings, "postprocess", start)
 
-    return results
\ No newline at end of file
+    return results
@@ -1,19 +1,56 @@
 import os, logging, time
 import cv2
-from queue import Queue, Full
+from queue import Queue, Full, Empty
 import threading
 
 logging.basicConfig(format='%(asctime)s  %(levelname)-10s %(message)s', datefmt="%Y-%m-%d-%H-%M-%S",
                     level=logging.INFO)
 
+class FrameMailbox:
+  '''
+  Single slot frame buffer: a new frame replaces the one nobody picked up yet.
+  Exposes the bits of the Queue interface VideoStream uses
+  '''
+
+  def __init__(self):
+    self.frame_ready = threading.Condition()
+    self.entry = None
+    self.dropped = 0
+
+  def put(self, entry):
+    with self.frame_ready:
+      if self.entry is not None:
+        self.dropped += 1
+      self.entry = entry
+      self.frame_ready.notify()
+
+  def get(self, timeout=None):
+    with self.frame_ready:
+      if not self.frame_ready.wait_for(lambda: self.entry is not None, timeout):
+        raise Empty
+      entry, self.entry = self.entry, None
+    return entry
+
+  def get_nowait(self):
+    with self.frame_ready:
+      if self.entry is None:
+        raise Empty
+      entry, self.entry = self.entry, None
+    return entry
+
+  def qsize(self):
+    return 0 if self.entry is None else 1
+
 class VideoStream:
   default_fps = 30.
 
-  def __init__(self, stream_source, interval=0.5):
+  def __init__(self, stream_source, interval=0.5, latest_only=None):
     '''
     Parameters:
       stream_source: RTSP, camera index, or video file name
       self.interval: how long to wait before next frame is served (sec)
+      latest_only: only keep the latest frame instead of queueing them.
+        Defaults to True for live RTSP sources
     '''
 
     if stream_source == "":
@@ -22,12 +59,15 @@ class VideoStream:
       raise ValueError("pulse interval should be positive, shorter than a day")
 
     self.keep_listeing_for_frames = True
-    self.frame_queue = Queue(100)
     self.cam = stream_source
     self.interval = interval 
     self.frame_grabber = None
     self.is_rtsp = str(self.cam).lower().startswith('rtsp')
 
+    self.latest_only = self.is_rtsp if latest_only is None else latest_only
+    self.frame_queue = FrameMailbox() if self.latest_only else Queue(100)
+    self.frames_captured = 0
+
     self.fps = None
     self.delay_frames = None
     self.delay_time = None
@@ -69,10 +109,24 @@ class VideoStream:
     self.frame_grabber.start()
     logging.info(f"Started listening for {self.cam}")
 
+  @property
+  def frames_dropped(self):
+    '''
+    Frames replaced in the mailbox before anyone read them
+    '''
+    return self.frame_queue.dropped if self.latest_only else 0
+
   def get_frame_with_id(self):
     '''
     Retrieves the frame together with its frame id
     '''
+    frame_id, frame, _ = self.get_frame_with_timestamp()
+    return frame_id, frame
+
+  def get_frame_with_timestamp(self):
+    '''
+    Retrieves the frame together with its frame id and capture time
+    '''
     return self.frame_queue.get()
 
   def setup_stream(self):
@@ -139,7 +193,8 @@ class VideoStream:
       if self.delay_frames is not None and (continuous_frame - 1) % self.delay_frames != 0:
         continue
 
-      self.frame_queue.put((continuous_frame, frame))
+      self.frames_captured += 1
+      self.frame_queue.put((continuous_frame, frame, time.time()))
 
     self.video_capture.release()
     self.video_capture = None
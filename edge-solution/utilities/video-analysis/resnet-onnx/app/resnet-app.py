@@ -1,7 +1,8 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-import threading
+import os
+import re
 import cv2
 import numpy as np
 import io
@@ -11,15 +12,54 @@ import json
 # Imports for the REST API
 from flask import Flask, request, jsonify, Response
 
+# onnxruntime session settings come from the environment of the container
+graph_optimization_levels = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+
+def request_threads():
+    '''
+    Requests scored at the same time: the --threads gunicorn runs with
+    '''
+    match = re.search(r"--threads[= ](\d+)", os.getenv("GUNICORN_CMD_ARGS", ""))
+    return int(match.group(1)) if match else 1
+
+def create_session_options():
+    '''
+    ORT_INTRA_OP_THREADS: threads of a single operator. Defaults to the cores divided by the
+      request threads, so that concurrent requests don't oversubscribe the cores. 0 uses every core
+    ORT_INTER_OP_THREADS: threads running independent operators, only used in parallel mode
+    ORT_GRAPH_OPTIMIZATION: disable, basic, extended or all
+    ORT_EXECUTION_MODE: sequential or parallel
+    ORT_CPU_MEM_ARENA, ORT_MEM_PATTERN: 0 turns off the memory arena or memory pattern planning
+    '''
+    options = onnxruntime.SessionOptions()
+    cores_per_request = max(1, len(os.sched_getaffinity(0)) // request_threads())
+    options.intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", cores_per_request))
+    options.inter_op_num_threads = int(os.getenv("ORT_INTER_OP_THREADS", "1"))
+    options.graph_optimization_level = graph_optimization_levels[os.getenv("ORT_GRAPH_OPTIMIZATION", "all")]
+
+    if os.getenv("ORT_EXECUTION_MODE", "sequential") == "parallel":
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    else:
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+
+    options.enable_cpu_mem_arena = os.getenv("ORT_CPU_MEM_ARENA", "1") != "0"
+    options.enable_mem_pattern = os.getenv("ORT_MEM_PATTERN", "1") != "0"
+
+    return options
+
 class ResnetModel:
     def __init__(self):
-        self._lock = threading.Lock()
-
         with open('synset.txt', "r") as f:
             self._labelList = [l.rstrip() for l in f]
 
         #print(self._labelList)
-        self._onnxSession = onnxruntime.InferenceSession('resnet50-v2-7.onnx')
+        # the session is safe to run from several threads at once
+        self._onnxSession = onnxruntime.InferenceSession('resnet50-v2-7.onnx', create_session_options())
 
     def Preprocess(self, cvImage):
         imageBlob = cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
@@ -54,10 +94,8 @@ class ResnetModel:
         return detectedObjects
 
     def Score(self, cvImage):
-        with self._lock:
-
-            imageBlob = self.Preprocess(cvImage)
-            probabilities = self._onnxSession.run(None, {"data": imageBlob})
+        imageBlob = self.Preprocess(cvImage)
+        probabilities = self._onnxSession.run(None, {"data": imageBlob})
          
         return self.Postprocess(probabilities)
 
@@ -3,21 +3,65 @@
 
 import onnxruntime
 from PIL import Image, ImageDraw, ImageFont
+import cv2
 import numpy as np
 import time
 import io
 import json
 import os
+import re
 from datetime import datetime
 import requests
 
 # Imports for the REST API
 from flask import Flask, request, jsonify, Response
 
+from letterbox import preprocess, decode_image
+
 session = None
 tags = []
 output_dir = 'images'
 
+# onnxruntime session settings come from the environment of the container
+graph_optimization_levels = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+
+def request_threads():
+    '''
+    Requests scored at the same time: the --threads gunicorn runs with
+    '''
+    match = re.search(r"--threads[= ](\d+)", os.getenv("GUNICORN_CMD_ARGS", ""))
+    return int(match.group(1)) if match else 1
+
+def create_session_options():
+    '''
+    ORT_INTRA_OP_THREADS: threads of a single operator. Defaults to the cores divided by the
+      request threads, so that concurrent requests don't oversubscribe the cores. 0 uses every core
+    ORT_INTER_OP_THREADS: threads running independent operators, only used in parallel mode
+    ORT_GRAPH_OPTIMIZATION: disable, basic, extended or all
+    ORT_EXECUTION_MODE: sequential or parallel
+    ORT_CPU_MEM_ARENA, ORT_MEM_PATTERN: 0 turns off the memory arena or memory pattern planning
+    '''
+    options = onnxruntime.SessionOptions()
+    cores_per_request = max(1, len(os.sched_getaffinity(0)) // request_threads())
+    options.intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", cores_per_request))
+    options.inter_op_num_threads = int(os.getenv("ORT_INTER_OP_THREADS", "1"))
+    options.graph_optimization_level = graph_optimization_levels[os.getenv("ORT_GRAPH_OPTIMIZATION", "all")]
+
+    if os.getenv("ORT_EXECUTION_MODE", "sequential") == "parallel":
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    else:
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+
+    options.enable_cpu_mem_arena = os.getenv("ORT_CPU_MEM_ARENA", "1") != "0"
+    options.enable_mem_pattern = os.getenv("ORT_MEM_PATTERN", "1") != "0"
+
+    return options
+
 # Called when the deployed service starts
 def init():
     global session
@@ -26,7 +70,8 @@ def init():
     
     model_path = 'yolov3/yolov3.onnx'
     # Initialize an inference session with  yoloV3 model
-    session = onnxruntime.InferenceSession(model_path) 
+    # requests share it, runs on it are thread safe
+    session = onnxruntime.InferenceSession(model_path, create_session_options())
     if (session != None):
         print('Session initialized')
     else:
@@ -45,29 +90,8 @@ def init():
         os.mkdir(output_dir)
     
 
-def letterbox_image(image, size):
-    '''Resize image with unchanged aspect ratio using padding'''
-    iw, ih = image.size
-    w, h = size
-    scale = min(w/iw, h/ih)
-    nw = int(iw*scale)
-    nh = int(ih*scale)
-
-    image = image.resize((nw,nh), Image.BICUBIC)
-    new_image = Image.new('RGB', size, (128,128,128))
-    new_image.paste(image, ((w-nw)//2, (h-nh)//2))
-
-    return new_image
-
-def preprocess(img):
-    model_image_size = (416, 416)
-    boxed_image = letterbox_image(img, tuple(reversed(model_image_size)))
-    image_data = np.array(boxed_image, dtype='float32')
-    image_data /= 255.
-    image_data = np.transpose(image_data, [2, 0, 1])
-    image_data = np.expand_dims(image_data, 0)
-    
-    return image_data
+def to_pil_image(img):
+    return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
 
 def postprocess(boxes, scores, indices, iw, ih, objectType=None, confidenceThreshold=0.0):
     
@@ -117,14 +141,14 @@ def processImage(img, objectType=None, confidenceThreshold=0.0):
     try:
         # Preprocess input according to the functions specified above
         img_data = preprocess(img)
-        img_size = np.array([img.size[1], img.size[0]], dtype=np.float32).reshape(1, 2)
+        ih, iw = img.shape[:2]
+        img_size = np.array([ih, iw], dtype=np.float32).reshape(1, 2)
 
         inference_time_start = time.time()
         boxes, scores, indices = session.run(None, {"input_1": img_data, "image_shape":img_size})
         inference_time_end = time.time()
         inference_duration = np.round(inference_time_end - inference_time_start, 2)
         
-        iw, ih = img.size
         detected_objects = postprocess(boxes, scores, indices, iw, ih, objectType, confidenceThreshold)
         return inference_duration, detected_objects
 
@@ -199,16 +223,14 @@ def score():
             except Exception as ex:
                 print('EXCEPTION:', str(ex))                                
 
-        imageData = io.BytesIO(request.get_data())
-
         # load the image
-        img = Image.open(imageData)
+        img = decode_image(request.get_data())
 
         inference_duration, detected_objects = processImage(img, objectType, confidenceThreshold)        
 
         try:        
             if stream is not None:
-                output_img = drawBboxes(img, detected_objects)
+                output_img = drawBboxes(to_pil_image(img), detected_objects)
 
                 imgBuf = io.BytesIO()
                 output_img.save(imgBuf, format='JPEG')
@@ -239,14 +261,13 @@ def score():
 def score_debug():
 
     try:
-        imageData = io.BytesIO(request.get_data())
         # load the image
-        img = Image.open(imageData)
+        img = decode_image(request.get_data())
 
         inference_duration, detected_objects = processImage(img)
         print('Inference duration was ', str(inference_duration))
 
-        output_img = drawBboxes(img, detected_objects)
+        output_img = drawBboxes(to_pil_image(img), detected_objects)
 
         # datetime object containing current date and time
         now = datetime.now()
@@ -268,14 +289,13 @@ def score_debug():
 @app.route('/annotate', methods=['POST'])
 def annotate():
     try:
-        imageData = io.BytesIO(request.get_data())
         # load the image
-        img = Image.open(imageData)
+        img = decode_image(request.get_data())
 
         inference_duration, detected_objects = processImage(img)
         print('Inference duration was ', str(inference_duration))
 
-        img = drawBboxes(img, detected_objects)
+        img = drawBboxes(to_pil_image(img), detected_objects)
         
         imgByteArr = io.BytesIO()        
         img.save(imgByteArr, format = 'JPEG')        
@@ -0,0 +1,71 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import threading
+import cv2
+import numpy as np
+
+model_image_size = (416, 416)
+# letterboxed image and input tensor, reused by each request thread
+preprocess_buffers = threading.local()
+
+def get_preprocess_buffers():
+    if getattr(preprocess_buffers, "boxed", None) is None:
+        h, w = model_image_size
+        preprocess_buffers.boxed = np.empty((h, w, 3), dtype=np.uint8)
+        preprocess_buffers.image_data = np.empty((1, 3, h, w), dtype=np.float32)
+
+    return preprocess_buffers.boxed, preprocess_buffers.image_data
+
+def bicubic_kernel(scale):
+    '''
+    PIL's bicubic (a = -0.5) stretched by the downscale factor, the way PIL filters before it samples
+    '''
+    radius = int(np.ceil(2*scale))
+    x = np.abs(np.arange(-radius, radius+1) / scale)
+    a = -0.5
+    kernel = np.where(x < 1, ((a+2)*x - (a+3))*x*x + 1, np.where(x < 2, (((x-5)*x + 8)*x - 4)*a, 0.))
+
+    return (kernel / kernel.sum()).astype(np.float32)
+
+def letterbox_image(image, boxed_image):
+    '''Resize image with unchanged aspect ratio into boxed_image, padding the rest'''
+    ih, iw = image.shape[:2]
+    h, w = boxed_image.shape[:2]
+    scale = min(w/iw, h/ih)
+    nw = int(iw*scale)
+    nh = int(ih*scale)
+    left = (w-nw)//2
+    top = (h-nh)//2
+
+    # only the padding is filled, the image is resized straight into the middle
+    boxed_image[:top] = 128
+    boxed_image[top+nh:] = 128
+    boxed_image[top:top+nh, :left] = 128
+    boxed_image[top:top+nh, left+nw:] = 128
+
+    # PIL smooths over the pixels a downscaled one covers, cubic sampling alone would alias
+    if scale < 1:
+        image = cv2.sepFilter2D(image, -1, bicubic_kernel(iw/nw), bicubic_kernel(ih/nh), borderType=cv2.BORDER_REFLECT)
+    cv2.resize(image, (nw, nh), dst=boxed_image[top:top+nh, left:left+nw], interpolation=cv2.INTER_CUBIC)
+
+    return boxed_image
+
+def preprocess(img):
+    '''
+    BGR image to the RGB, 0-1, NCHW model input. The returned tensor is reused by the next call of the thread
+    '''
+    boxed_image, image_data = get_preprocess_buffers()
+    letterbox_image(img, boxed_image)
+
+    # BGR -> RGB, HWC -> CHW and scaling in one pass
+    np.divide(boxed_image[..., ::-1].transpose((2, 0, 1)), np.float32(255.), out=image_data[0], dtype=np.float32)
+    
+    return image_data
+
+def decode_image(data):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    return img
@@ -0,0 +1,131 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Checks the OpenCV letterbox preprocessing in app/letterbox.py against the PIL
+# implementation it replaced, on images of several sizes and aspect ratios.
+#
+#   python validate_letterbox.py [--images photo.jpg ...] [app folder ...]
+#
+# Defaults to the app folder next to this script. Next to the generated test images
+# it checks the images given, camera snapshots are the content that matters.
+# Needs numpy, opencv-python and pillow.
+
+import io
+import os
+import sys
+import argparse
+import importlib.util
+import cv2
+import numpy as np
+from PIL import Image
+
+# sizes (height, width) of the test images: landscape, portrait, upscaled and model sized
+image_sizes = [(1080, 1920), (480, 640), (720, 540), (300, 200), (100, 300), (416, 416)]
+
+# allowed difference in 0-255 levels. OpenCV samples with its own cubic (a = -0.75, PIL uses
+# -0.5) and after downscaling it samples the smoothed image rather than weighing the pixels at
+# the exact position. Both only show next to sharp edges: single pixels beside one pixel wide
+# stripes get up to ~30 levels apart, 99% of the tensor stays within a few levels and the mean
+# within one level (0.4%), below the JPEG noise the camera frames come with
+max_level_diff = 32
+p99_level_diff = 8
+mean_level_diff = 1
+
+def pil_letterbox_image(image, size):
+    '''Resize image with unchanged aspect ratio using padding'''
+    iw, ih = image.size
+    w, h = size
+    scale = min(w/iw, h/ih)
+    nw = int(iw*scale)
+    nh = int(ih*scale)
+
+    image = image.resize((nw,nh), Image.BICUBIC)
+    new_image = Image.new('RGB', size, (128,128,128))
+    new_image.paste(image, ((w-nw)//2, (h-nh)//2))
+
+    return new_image
+
+def pil_preprocess(img):
+    model_image_size = (416, 416)
+    boxed_image = pil_letterbox_image(img, tuple(reversed(model_image_size)))
+    image_data = np.array(boxed_image, dtype='float32')
+    image_data /= 255.
+    image_data = np.transpose(image_data, [2, 0, 1])
+    image_data = np.expand_dims(image_data, 0)
+
+    return image_data
+
+def smooth_image(height, width, rng):
+    '''
+    Smooth gradients with sensor like noise
+    '''
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255. / width, y * 255. / height, (x + y) * 127. / (width + height)], axis=-1)
+    image += rng.normal(0, 8, image.shape)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+def textured_image(height, width, rng):
+    '''
+    The worst case for resampling: hard edged blocks, a fine checkerboard, single pixel stripes and text
+    '''
+    y, x = np.mgrid[0:height, 0:width]
+    blocks = rng.integers(0, 256, (height // 10 + 1, width // 10 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(blocks, (width, height), interpolation=cv2.INTER_NEAREST)
+    image[:height // 3, :, 0] = (x[:height // 3] // 8 + y[:height // 3] // 8) % 2 * 255
+    image[:height // 3, :, 1] = x[:height // 3] % 2 * 255
+    cv2.putText(image, "ABC xyz 123", (5, height // 2), cv2.FONT_HERSHEY_SIMPLEX, max(width, height) / 600, (255, 255, 255), 2)
+
+    return image
+
+def test_images(image_files):
+    rng = np.random.default_rng(0)
+    for height, width in image_sizes:
+        yield f"{width}x{height} smooth", smooth_image(height, width, rng)
+        yield f"{width}x{height} textured", textured_image(height, width, rng)
+
+    for image_file in image_files:
+        image = cv2.imread(image_file, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not read {image_file}")
+        yield f"{os.path.basename(image_file)} {image.shape[1]}x{image.shape[0]}", image
+
+def load_letterbox(app_dir):
+    spec = importlib.util.spec_from_file_location("letterbox", os.path.join(app_dir, "letterbox.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def validate(app_dir, image_files):
+    letterbox = load_letterbox(app_dir)
+    passed = True
+
+    for name, image in test_images(image_files):
+        _, encoded = cv2.imencode(".png", image)
+        data = encoded.tobytes()
+
+        expected = pil_preprocess(Image.open(io.BytesIO(data)).convert('RGB'))
+        actual = letterbox.preprocess(letterbox.decode_image(data))
+
+        diff = np.abs(expected - actual) * 255
+        p99 = np.percentile(diff, 99)
+        ok = expected.shape == actual.shape and diff.max() <= max_level_diff and p99 <= p99_level_diff and diff.mean() <= mean_level_diff
+        # nothing to resample, the two have to agree exactly
+        if image.shape[:2] == letterbox.model_image_size:
+            ok = ok and diff.max() == 0
+
+        print(f"{app_dir} {name}: max {diff.max():.1f} p99 {p99:.1f} mean {diff.mean():.3f} levels {'ok' if ok else 'FAILED'}")
+        passed = passed and ok
+
+    return passed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the OpenCV letterbox against the PIL one")
+    parser.add_argument("app_dirs", nargs="*", help="folders with a letterbox.py, the app folder next to this script by default")
+    parser.add_argument("--images", nargs="*", default=[], help="images to check besides the generated ones")
+    args = parser.parse_args()
+
+    app_dirs = args.app_dirs or [os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")]
+
+    results = [validate(app_dir, args.images) for app_dir in app_dirs]
+    sys.exit(0 if all(results) else 1)
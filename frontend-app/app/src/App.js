@@ -304,6 +304,13 @@ class App extends React.Component {
     }
 
     async updateData(data) {
+        if (data && data.hasOwnProperty('body') && data.body.hasOwnProperty('messages')) {
+            // messages coalesced by the camera module
+            for (const message of data.body.messages) {
+                await this.updateData({ body: message.body });
+            }
+            return;
+        }
         if (data && data.hasOwnProperty('body')) {
             const frame = data.body;
             if (frame.hasOwnProperty("cameraId")) {
@@ -313,7 +320,12 @@ class App extends React.Component {
                     const l = frame.detections.length;
                     for (let i = 0; i < l; i++) {
                         const detection = frame.detections[i];
-                        if (detection.bbox) {
+                        if (detection.hasOwnProperty('collides')) {
+                            // already checked against the zones on the edge
+                            if (detection.collides) {
+                                collisions = collisions + 1;
+                            }
+                        } else if (detection.bbox) {
                             if (collision.isBBoxInZones(detection.bbox, this.state.aggregator.zones)) {
                                 detection.collides = true;
                                 collisions = collisions + 1;
@@ -329,9 +341,16 @@ class App extends React.Component {
                         detections: detections
                     });
                 }
+                if (frame.hasOwnProperty('zones') && !this.state.rtcv) {
+                    // counted on the edge, no boxes come with it
+                    this.setState({
+                        collisions: frame.collisions,
+                        detections: frame.detectionCount
+                    });
+                }
                 if (frame.hasOwnProperty("image_name")) {
                     const image = new Image();
-                    image.src = await blobImage.updateImage(blobServiceClient, containerName, blobPath, frame.image_name);
+                    image.src = await blobImage.updateImage(blobServiceClient, containerName, blobPath, frame.image_name, frame.image_format);
                     this.setState({
                         image: image
                     });
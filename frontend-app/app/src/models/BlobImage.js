@@ -1,12 +1,13 @@
 export class BlobImage {
-    async updateImage(blobServiceClient, containerName, blobPath, imageName) {
-        const blobName = `${blobPath}/${imageName.split('T')[0]}/${imageName}.jpg`;
+    async updateImage(blobServiceClient, containerName, blobPath, imageName, imageFormat = 'jpg') {
+        const blobName = `${blobPath}/${imageName.split('T')[0]}/${imageName}.${imageFormat}`;
         const containerClient = blobServiceClient.getContainerClient(containerName);
         const blobClient = containerClient.getBlobClient(blobName);
 
         const downloadBlockBlobResponse = await blobClient.download();
         const downloaded = await this.blobToBinaryString(await downloadBlockBlobResponse.blobBody);
-        return `data:image/jpeg;base64,${btoa(downloaded)}`;
+        const mimeType = imageFormat === 'jpg' ? 'image/jpeg' : `image/${imageFormat}`;
+        return `data:${mimeType};base64,${btoa(downloaded)}`;
     }
 
     async blobToBinaryString(blob) {